@@ -0,0 +1,179 @@
+import os
+import re
+import shutil
+import logging
+import threading
+import subprocess
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+import instagram_dl
+import instagram_session
+
+logger = logging.getLogger(__name__)
+
+SHORTCODE_PATTERN = re.compile(r'^bench([a-z]+)\d+$')
+VIDEO_CODECS = {
+    'reel.mp4': ('mp4v.20.9', 'mp4a.40.2'),
+    'clip.mp4': ('avc1.64001f', 'mp4a.40.2')
+}
+
+def generate_fixtures(fixture_dir, video_seconds=15):
+    os.makedirs(fixture_dir, exist_ok=True)
+    fixtures = {}
+
+    photo = f'{fixture_dir}/photo.jpg'
+    if not os.path.exists(photo):
+        Image.effect_mandelbrot((1080, 1350), (-2.0, -1.2, 0.8, 1.2), 100).convert('RGB').save(photo, quality=90)
+    fixtures['photo'] = ['photo.jpg']
+    fixtures['album'] = ['photo.jpg'] * 4
+
+    if not shutil.which('ffmpeg'):
+        logger.warning('ffmpeg not found, video fixtures (reel, clip, carousel) are unavailable')
+        return fixtures
+
+    encodes = {
+        # Needs a full transcode: MPEG-4 Part 2 video is not Telegram-compatible.
+        'reel.mp4': ['-c:v', 'mpeg4', '-q:v', '4', '-c:a', 'aac'],
+        # Already compliant H.264/AAC with faststart: remux or stream straight through.
+        'clip.mp4': ['-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-movflags', '+faststart']
+    }
+    for name, codec_args in encodes.items():
+        path = f'{fixture_dir}/{name}'
+        if os.path.exists(path):
+            continue
+        cmd = [
+            'ffmpeg', '-f', 'lavfi', '-i', f'testsrc2=size=720x1280:rate=30:duration={video_seconds}',
+            '-f', 'lavfi', '-i', f'sine=frequency=440:duration={video_seconds}'
+        ] + codec_args + ['-shortest', '-y', path]
+        subprocess.run(cmd, capture_output=True, check=True)
+    fixtures['reel'] = ['reel.mp4']
+    fixtures['clip'] = ['clip.mp4']
+    fixtures['carousel'] = ['photo.jpg', 'reel.mp4', 'photo.jpg', 'clip.mp4']
+    return fixtures
+
+class FakeInstagram:
+    def __init__(self, fixture_dir, fixtures):
+        self.fixture_dir = fixture_dir
+        self.fixtures = fixtures
+        self.server = None
+        self.base_url = None
+        self.lock = threading.Lock()
+        self.bytes_out = 0
+
+    def start(self, host='127.0.0.1', port=0):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                path = os.path.join(fake.fixture_dir, os.path.basename(self.path))
+                if not os.path.isfile(path):
+                    self.send_error(404)
+                    return
+                size = os.path.getsize(path)
+                start = 0
+                match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+                if match and int(match.group(1)) < size:
+                    start = int(match.group(1))
+                    self.send_response(206)
+                    self.send_header('Content-Range', f'bytes {start}-{size - 1}/{size}')
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(size - start))
+                self.end_headers()
+                with open(path, 'rb') as f:
+                    f.seek(start)
+                    shutil.copyfileobj(f, self.wfile)
+                with fake.lock:
+                    fake.bytes_out += size - start
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='fake-instagram', daemon=True).start()
+        self.base_url = f'http://{host}:{self.server.server_address[1]}'
+        return self.base_url
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def kind(self, url):
+        match = SHORTCODE_PATTERN.match(instagram_dl.get_shortcode(url) or '')
+        return match.group(1) if match and match.group(1) in self.fixtures else None
+
+    def kind_of(self, shortcode):
+        return self.kind(f'https://www.instagram.com/p/{shortcode}/')
+
+    def fetch_metadata(self, url):
+        # Stands in for yt-dlp's extractor only: single-video posts get
+        # formats pointing at the fake CDN and go through the real stream
+        # checks and YoutubeDL download, everything else fails the way
+        # yt-dlp does on photo posts and falls back to instagrapi.
+        kind = self.kind(url)
+        names = self.fixtures.get(kind) or []
+        if len(names) != 1 or names[0] not in VIDEO_CODECS:
+            raise RuntimeError(f'No video formats found for {url}')
+        shortcode = instagram_dl.get_shortcode(url)
+        vcodec, acodec = VIDEO_CODECS[names[0]]
+        size = os.path.getsize(f'{self.fixture_dir}/{names[0]}')
+        info = {
+            'id': shortcode,
+            'title': f'bench {kind}',
+            'ext': 'mp4',
+            'url': f'{self.base_url}/{names[0]}',
+            'protocol': 'http',
+            'vcodec': vcodec,
+            'acodec': acodec,
+            'filesize': size,
+            'uploader_id': 'bench',
+            'description': kind,
+            'extractor': 'Instagram',
+            'extractor_key': 'Instagram',
+            'webpage_url': url
+        }
+        return {'id': shortcode, 'info': info, 'entries': [info], 'size_mb': size / (1024 * 1024)}
+
+    def media_info(self, shortcode):
+        names = self.fixtures.get(self.kind_of(shortcode))
+        if not names:
+            raise RuntimeError(f'Media not found: {shortcode}')
+        items = [
+            SimpleNamespace(media_type=2, video_url=f'{self.base_url}/{name}', thumbnail_url=None)
+            if name in VIDEO_CODECS else
+            SimpleNamespace(media_type=1, video_url=None, thumbnail_url=f'{self.base_url}/{name}')
+            for name in names
+        ]
+        common = {'user': SimpleNamespace(username='bench'), 'caption_text': self.kind_of(shortcode)}
+        if len(items) == 1:
+            return SimpleNamespace(**vars(items[0]), resources=[], **common)
+        return SimpleNamespace(media_type=8, video_url=None, thumbnail_url=None, resources=items, **common)
+
+    def install(self):
+        # Only the network edges are replaced: yt-dlp's extractor and the
+        # instagrapi client inside each pooled session. download_instagram,
+        # stream_plan, fetch_resources and the session pool run for real.
+        instagram_dl.fetch_metadata = self.fetch_metadata
+        instagram_session.init_sessions()
+        for session in instagram_session.sessions:
+            session['client'] = FakeClient(self)
+
+class FakeClient:
+    def __init__(self, instagram):
+        self.instagram = instagram
+
+    def media_pk_from_code(self, shortcode):
+        return shortcode
+
+    def media_info(self, media_pk):
+        return self.instagram.media_info(media_pk)
+
+    def dump_settings(self, path):
+        with open(path, 'w') as f:
+            f.write('{}')
@@ -0,0 +1,151 @@
+import json
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TERMINAL_PREFIXES = ('Done', 'Download failed', 'This post is too large', 'No media found')
+MEDIA_METHODS = ('sendVideo', 'sendPhoto', 'sendAudio', 'sendMediaGroup')
+
+def read_body(handler):
+    if handler.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int(handler.rfile.readline().split(b';')[0].strip() or b'0', 16)
+            if size == 0:
+                handler.rfile.readline()
+                return b''.join(chunks)
+            chunks.append(handler.rfile.read(size))
+            handler.rfile.readline()
+    length = int(handler.headers.get('Content-Length') or 0)
+    return handler.rfile.read(length) if length else b''
+
+def form_fields(body, content_type):
+    boundary = content_type.split('boundary=', 1)[1].strip('"').encode('utf-8')
+    fields = {}
+    for part in body.split(b'--' + boundary):
+        head, _, value = part.partition(b'\r\n\r\n')
+        if b'name="' not in head or b'filename="' in head:
+            continue
+        name = head.split(b'name="', 1)[1].split(b'"', 1)[0].decode('utf-8')
+        fields[name] = value[:-2].decode('utf-8', 'replace') if value.endswith(b'\r\n') else value.decode('utf-8', 'replace')
+    return fields
+
+def parse_payload(handler, body):
+    content_type = handler.headers.get('Content-Type', '')
+    if content_type.startswith('application/json'):
+        return json.loads(body or b'{}')
+    if content_type.startswith('multipart/form-data'):
+        return form_fields(body, content_type)
+    return {}
+
+class FakeTelegram:
+    def __init__(self, latency=0.05, jitter=0.02, throttle_rate=0.0, retry_after=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.message_ids = iter(range(1, 10 ** 9))
+        self.calls = {}
+        self.throttled = 0
+        self.bytes_in = 0
+        self.completed = {}
+        self.updates = []
+        self.updates_cond = threading.Condition()
+        self.server = None
+
+    def start(self, host='127.0.0.1', port=0):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = read_body(self)
+                method = self.path.rstrip('/').rsplit('/', 1)[-1]
+                status, response = fake.handle(method, parse_payload(self, body), len(body))
+                data = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='fake-telegram', daemon=True).start()
+        return f'http://{host}:{self.server.server_address[1]}'
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def push_update(self, update):
+        with self.updates_cond:
+            self.updates.append(update)
+            self.updates_cond.notify_all()
+
+    def get_updates(self, payload):
+        offset = int(payload.get('offset') or 0)
+        deadline = time.time() + float(payload.get('timeout') or 0)
+        with self.updates_cond:
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            while not self.updates and time.time() < deadline:
+                self.updates_cond.wait(deadline - time.time())
+            return list(self.updates[:100])
+
+    def handle(self, method, payload, size):
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self.get_updates(payload)}
+        time.sleep(max(0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self.bytes_in += size
+            if method in MEDIA_METHODS + ('sendMessage', 'editMessageText') and random.random() < self.throttle_rate:
+                self.throttled += 1
+                return 429, {
+                    'ok': False,
+                    'error_code': 429,
+                    'description': f'Too Many Requests: retry after {self.retry_after}',
+                    'parameters': {'retry_after': self.retry_after}
+                }
+            message_id = next(self.message_ids)
+
+        text = payload.get('text') or ''
+        chat_id = str(payload.get('chat_id', ''))
+        if method in ('sendMessage', 'editMessageText') and text.startswith(TERMINAL_PREFIXES):
+            with self.lock:
+                self.completed.setdefault(chat_id, (time.time(), text.startswith('Done')))
+
+        if method == 'sendMediaGroup':
+            media = payload.get('media') or []
+            if isinstance(media, str):
+                media = json.loads(media)
+            return 200, {'ok': True, 'result': [self.message(message_id * 100 + i) for i in range(len(media))]}
+        if method in ('deleteMessage', 'answerCallbackQuery', 'deleteWebhook'):
+            return 200, {'ok': True, 'result': True}
+        if method == 'getFile':
+            return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: file is not available'}
+        return 200, {'ok': True, 'result': self.message(message_id)}
+
+    def message(self, message_id):
+        file_id = f'fake-{message_id}'
+        return {
+            'message_id': message_id,
+            'photo': [{'file_id': file_id}],
+            'video': {'file_id': file_id},
+            'audio': {'file_id': file_id}
+        }
+
+    def completion(self, chat_id):
+        with self.lock:
+            return self.completed.get(str(chat_id))
+
+    def stats(self):
+        with self.lock:
+            return {'calls': dict(self.calls), 'throttled': self.throttled, 'bytes_in': self.bytes_in}
@@ -0,0 +1,286 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import asyncio
+import argparse
+import resource
+import tempfile
+import threading
+from benchmarks.fake_telegram import FakeTelegram
+
+logger = logging.getLogger('benchmark')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Drive the webhook against local Telegram and Instagram stand-ins.')
+    parser.add_argument('--mode', choices=('webhook', 'poll'), default='webhook',
+                        help='feed updates through the Flask webhook or the getUpdates poller')
+    parser.add_argument('--jobs', type=int, default=50, help='number of link updates to send')
+    parser.add_argument('--rate', type=float, default=2.0, help='updates per second')
+    parser.add_argument('--mix', default='photo=2,album=1,reel=2,clip=1,carousel=1',
+                        help='weighted fixture kinds, e.g. photo=2,reel=1')
+    parser.add_argument('--repeat', type=float, default=0.0, help='fraction of links that reuse an earlier post')
+    parser.add_argument('--tg-latency', type=float, default=0.05, help='fake Bot API latency in seconds')
+    parser.add_argument('--tg-429-rate', type=float, default=0.0, help='fraction of sends answered with 429')
+    parser.add_argument('--video-seconds', type=int, default=15, help='length of the generated video fixtures')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds to wait for outstanding jobs')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--fixture-dir', default=f'{tempfile.gettempdir()}/bench-fixtures')
+    parser.add_argument('--json', help='write the report to this file')
+    parser.add_argument('--max-p95', type=float, help='fail if p95 latency exceeds this many seconds')
+    parser.add_argument('--min-throughput', type=float, help='fail if jobs/sec drops below this')
+    parser.add_argument('--verbose', action='store_true')
+    return parser.parse_args()
+
+def parse_mix(text):
+    kinds = []
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        kinds += [kind.strip()] * int(weight or 1)
+    return kinds
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))]
+
+def child_cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+class TempSampler:
+    def __init__(self, temp_files, interval=0.2):
+        self.temp_files = temp_files
+        self.interval = interval
+        self.baseline = self.usage()
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='bench-tmp-sampler', daemon=True)
+
+    def usage(self):
+        return sum(size for _, size, _ in self.temp_files())
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, self.usage() - self.baseline)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+def build_updates(args, available):
+    rng = random.Random(args.seed)
+    kinds = [kind for kind in parse_mix(args.mix) if kind in available]
+    skipped = set(parse_mix(args.mix)) - set(kinds)
+    if skipped:
+        logger.warning(f'Skipping unavailable fixture kinds: {", ".join(sorted(skipped))}')
+    if not kinds:
+        raise SystemExit('No fixture kinds available for this mix')
+
+    updates = []
+    shortcodes = []
+    for i in range(args.jobs):
+        if shortcodes and rng.random() < args.repeat:
+            shortcode = rng.choice(shortcodes)
+        else:
+            shortcode = f'bench{rng.choice(kinds)}{i}'
+            shortcodes.append(shortcode)
+        chat_id = 100000 + i
+        updates.append({
+            'update_id': i,
+            'message': {
+                'message_id': i,
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': f'https://www.instagram.com/p/{shortcode}/'
+            }
+        })
+    return updates
+
+def drive(deliver, updates, rate):
+    sent = {}
+    rejected = 0
+    start = time.time()
+    for i, update in enumerate(updates):
+        delay = start + i / rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        chat_id = update['message']['chat']['id']
+        sent_at = time.time()
+        if not deliver(update):
+            rejected += 1
+            continue
+        sent[chat_id] = sent_at
+    return sent, rejected
+
+def webhook_sender(app):
+    client = app.test_client()
+    return lambda update: client.post('/webhook', json=update).status_code != 503
+
+def start_poller(telegram):
+    import poller
+    stopping = {}
+    ready = threading.Event()
+
+    def run_loop():
+        async def main():
+            stopping['event'] = asyncio.Event()
+            stopping['loop'] = asyncio.get_running_loop()
+            ready.set()
+            await poller.poll(stopping['event'])
+        asyncio.run(main())
+
+    thread = threading.Thread(target=run_loop, name='bench-poller', daemon=True)
+    thread.start()
+    ready.wait()
+
+    def stop():
+        stopping['loop'].call_soon_threadsafe(stopping['event'].set)
+        thread.join(timeout=5)
+
+    def deliver(update):
+        telegram.push_update(update)
+        return True
+    return deliver, stop
+
+def wait_for(telegram, sent, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if all(telegram.completion(chat_id) for chat_id in sent):
+            return True
+        time.sleep(0.2)
+    return False
+
+def report(args, telegram, sent, rejected, cpu_seconds, peak_tmp, app_stats):
+    latencies = []
+    failed = 0
+    finished_at = []
+    for chat_id, sent_at in sent.items():
+        completion = telegram.completion(chat_id)
+        if not completion:
+            continue
+        done_at, ok = completion
+        finished_at.append(done_at)
+        if ok:
+            latencies.append(done_at - sent_at)
+        else:
+            failed += 1
+    completed = len(finished_at)
+    elapsed = max(finished_at) - min(sent.values()) if finished_at else 0
+    return {
+        'jobs': args.jobs,
+        'rate': args.rate,
+        'mix': args.mix,
+        'accepted': len(sent),
+        'rejected': rejected,
+        'completed': completed,
+        'failed': failed,
+        'timed_out': len(sent) - completed,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'latency_p99': percentile(latencies, 99),
+        'jobs_per_sec': completed / elapsed if elapsed else 0.0,
+        'ffmpeg_cpu_seconds': cpu_seconds,
+        'ffmpeg_cpu_seconds_per_job': cpu_seconds / completed if completed else 0.0,
+        'peak_tmp_mb': peak_tmp / (1024 * 1024),
+        'telegram': telegram.stats(),
+        **app_stats
+    }
+
+def print_report(result):
+    print(f'jobs        {result["completed"]}/{result["accepted"]} completed, {result["failed"]} failed, '
+          f'{result["timed_out"]} timed out, {result["rejected"]} rejected (503)')
+    print(f'latency     p50={result["latency_p50"]:.2f}s p95={result["latency_p95"]:.2f}s p99={result["latency_p99"]:.2f}s')
+    print(f'throughput  {result["jobs_per_sec"]:.2f} jobs/sec')
+    print(f'ffmpeg cpu  {result["ffmpeg_cpu_seconds"]:.1f}s total, {result["ffmpeg_cpu_seconds_per_job"]:.2f}s/job')
+    print(f'peak /tmp   {result["peak_tmp_mb"]:.1f} MB')
+    print(f'telegram    {result["telegram"]["calls"]} ({result["telegram"]["throttled"]} throttled)')
+
+def run():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    work_dir = tempfile.mkdtemp(prefix='bench-data-')
+
+    # config reads the API base at import time, so the fake Bot API has to be
+    # listening before anything from the bot is imported.
+    telegram = FakeTelegram(latency=args.tg_latency, throttle_rate=args.tg_429_rate)
+    os.environ.update({
+        'TELEGRAM_BOT_TOKEN': 'bench',
+        'BOT_MODE': args.mode,
+        'TELEGRAM_API_BASE': telegram.start(),
+        'DATA_DIR': work_dir,
+        'COOKIE_BASE64': ''
+    })
+    # The real session pool runs, so give it enough budget for the load.
+    os.environ.setdefault('INSTAGRAM_SESSION_RATE', '6000')
+
+    from benchmarks.fake_instagram import FakeInstagram, generate_fixtures
+    import handlers
+    import janitor
+    import pipeline
+    import rate_limiter
+    import transcode_scheduler
+    from config import POLLER_CONCURRENCY
+
+    fixtures = generate_fixtures(args.fixture_dir, args.video_seconds)
+    instagram = FakeInstagram(args.fixture_dir, fixtures)
+    instagram.start()
+    instagram.install()
+    stop_poller = None
+    if args.mode == 'poll':
+        handlers.start(POLLER_CONCURRENCY)
+        deliver, stop_poller = start_poller(telegram)
+    else:
+        import main as app_module
+        deliver = webhook_sender(app_module.app)
+
+    updates = build_updates(args, fixtures)
+    sampler = TempSampler(janitor.temp_files)
+    sampler.start()
+    cpu_before = child_cpu_seconds()
+    try:
+        sent, rejected = drive(deliver, updates, args.rate)
+        if not wait_for(telegram, sent, args.timeout):
+            logger.warning('Timed out waiting for outstanding jobs')
+        # ffmpeg runs as a direct child and is reaped per encode, so it is
+        # counted here; the photo process pool is only reaped on shutdown.
+        cpu_seconds = child_cpu_seconds() - cpu_before
+    finally:
+        sampler.stop()
+        if stop_poller:
+            stop_poller()
+        if pipeline.process_pool:
+            pipeline.process_pool.shutdown(wait=False, cancel_futures=True)
+        instagram.stop()
+        telegram.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    result = report(args, telegram, sent, rejected, cpu_seconds, sampler.peak, {
+        'rate_limiter': rate_limiter.limiter_stats(),
+        'transcode': transcode_scheduler.encode_stats(),
+        'cdn_bytes_out': instagram.bytes_out
+    })
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    failures = []
+    if args.max_p95 is not None and result['latency_p95'] > args.max_p95:
+        failures.append(f'p95 latency {result["latency_p95"]:.2f}s exceeds {args.max_p95:.2f}s')
+    if args.min_throughput is not None and result['jobs_per_sec'] < args.min_throughput:
+        failures.append(f'throughput {result["jobs_per_sec"]:.2f} jobs/sec is below {args.min_throughput:.2f}')
+    if result['timed_out'] or result['failed']:
+        failures.append(f'{result["failed"]} failed and {result["timed_out"]} timed out job(s)')
+    for failure in failures:
+        print(f'FAIL: {failure}', file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(run())
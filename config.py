@@ -2,9 +2,64 @@ import os
 
 TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '')
 COOKIE_BASE64 = os.environ.get('COOKIE_BASE64', '')
-TELEGRAM_API = f'https://api.telegram.org/bot{TOKEN}'
+TELEGRAM_API_BASE = os.environ.get('TELEGRAM_API_BASE', 'https://api.telegram.org')
+TELEGRAM_API = f'{TELEGRAM_API_BASE}/bot{TOKEN}'
+TELEGRAM_FILE_API = f'{TELEGRAM_API_BASE}/file/bot{TOKEN}'
 TEMP_DIR = '/tmp'
 MAX_FILE_SIZE_MB = 48
+GET_FILE_MAX_SIZE_MB = 20
 MAX_VIDEO_DURATION = 300
 AUDIO_CACHE_TIMEOUT = 120
 COMPRESSION_QUALITY = 23
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', '2'))
+BOT_MODE = os.environ.get('BOT_MODE', 'webhook')
+POLLER_CONCURRENCY = int(os.environ.get('POLLER_CONCURRENCY', '32'))
+JOB_WORKERS = POLLER_CONCURRENCY if BOT_MODE == 'poll' else WORKER_CONCURRENCY
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', str(max(50, JOB_WORKERS * 4))))
+DATA_DIR = os.environ.get('DATA_DIR', TEMP_DIR)
+RESULT_CACHE_PATH = os.environ.get('RESULT_CACHE_PATH', f'{DATA_DIR}/result_cache.db')
+RESULT_CACHE_TTL = int(os.environ.get('RESULT_CACHE_TTL', '86400'))
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', '2000'))
+AUDIO_FORMAT = os.environ.get('AUDIO_FORMAT', 'm4a')
+TELEGRAM_TIMEOUT = float(os.environ.get('TELEGRAM_TIMEOUT', '30'))
+TELEGRAM_UPLOAD_TIMEOUT = float(os.environ.get('TELEGRAM_UPLOAD_TIMEOUT', '300'))
+TELEGRAM_MAX_RETRIES = int(os.environ.get('TELEGRAM_MAX_RETRIES', '3'))
+TELEGRAM_POOL_SIZE = int(os.environ.get('TELEGRAM_POOL_SIZE', str(max(10, JOB_WORKERS * 2))))
+MEDIA_PROCESS_WORKERS = int(os.environ.get('MEDIA_PROCESS_WORKERS', '2'))
+IO_THREADS = int(os.environ.get('IO_THREADS', str(max(4, JOB_WORKERS))))
+INSTAGRAM_DOWNLOAD_FANOUT = int(os.environ.get('INSTAGRAM_DOWNLOAD_FANOUT', '4'))
+INSTAGRAM_DOWNLOAD_DEADLINE = int(os.environ.get('INSTAGRAM_DOWNLOAD_DEADLINE', '120'))
+COOKIE_FILE = os.environ.get('COOKIE_FILE', f'{DATA_DIR}/cookies.txt')
+INSTAGRAM_SESSION_DIR = os.environ.get('INSTAGRAM_SESSION_DIR', f'{DATA_DIR}/instagram_sessions')
+INSTAGRAM_SESSION_COUNT = int(os.environ.get('INSTAGRAM_SESSION_COUNT', '2'))
+INSTAGRAM_SESSION_RATE = float(os.environ.get('INSTAGRAM_SESSION_RATE', '20'))
+INSTAGRAM_SESSION_COOLDOWN = int(os.environ.get('INSTAGRAM_SESSION_COOLDOWN', '600'))
+INSTAGRAM_SESSION_WAIT = int(os.environ.get('INSTAGRAM_SESSION_WAIT', '30'))
+MAX_SOURCE_SIZE_MB = int(os.environ.get('MAX_SOURCE_SIZE_MB', '300'))
+JOB_DB_PATH = os.environ.get('JOB_DB_PATH', f'{DATA_DIR}/jobs.db')
+CHAT_LOCK_LEASE = int(os.environ.get('CHAT_LOCK_LEASE', '600'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '2'))
+JANITOR_INTERVAL = int(os.environ.get('JANITOR_INTERVAL', '60'))
+TEMP_STALE_AGE = int(os.environ.get('TEMP_STALE_AGE', '1800'))
+TEMP_DISK_BUDGET_MB = int(os.environ.get('TEMP_DISK_BUDGET_MB', '400'))
+CHAT_QUEUE_LIMIT = int(os.environ.get('CHAT_QUEUE_LIMIT', '10'))
+PROGRESS_UPDATE_INTERVAL = float(os.environ.get('PROGRESS_UPDATE_INTERVAL', '3'))
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', '30'))
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_CHAT_BURST = int(os.environ.get('TELEGRAM_CHAT_BURST', '3'))
+TELEGRAM_GROUP_RATE = float(os.environ.get('TELEGRAM_GROUP_RATE', '20'))
+TELEGRAM_THROTTLE_RETRIES = int(os.environ.get('TELEGRAM_THROTTLE_RETRIES', '5'))
+TRANSCODE_SLOTS = int(os.environ.get('TRANSCODE_SLOTS', '0'))
+TRANSCODE_PRESET = os.environ.get('TRANSCODE_PRESET', 'medium')
+TRANSCODE_TIMEOUT = int(os.environ.get('TRANSCODE_TIMEOUT', '180'))
+TRANSCODE_SLOT_DIR = os.environ.get('TRANSCODE_SLOT_DIR', f'{DATA_DIR}/transcode_slots')
+TRANSCODE_SLOT_WAIT = int(os.environ.get('TRANSCODE_SLOT_WAIT', '600'))
+MAX_PHOTO_SIZE_MB = int(os.environ.get('MAX_PHOTO_SIZE_MB', '10'))
+MAX_PHOTO_DIMENSIONS = int(os.environ.get('MAX_PHOTO_DIMENSIONS', '10000'))
+METRICS_TRACE = os.environ.get('METRICS_TRACE', '0') == '1'
+POLL_TIMEOUT = int(os.environ.get('POLL_TIMEOUT', '30'))
+POLLER_OFFSET_PATH = os.environ.get('POLLER_OFFSET_PATH', f'{DATA_DIR}/poller_offset')
+POLLER_DRAIN_TIMEOUT = int(os.environ.get('POLLER_DRAIN_TIMEOUT', '60'))
+BATCH_MAX_LINKS = int(os.environ.get('BATCH_MAX_LINKS', '10'))
+CALLBACK_THREADS = int(os.environ.get('CALLBACK_THREADS', '2'))
+BATCH_FETCH_CONCURRENCY = int(os.environ.get('BATCH_FETCH_CONCURRENCY', str(max(4, JOB_WORKERS // 4))))
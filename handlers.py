@@ -0,0 +1,572 @@
+import os
+import logging
+import threading
+from concurrent.futures import as_completed
+from config import AUDIO_CACHE_TIMEOUT, AUDIO_FORMAT, TEMP_DIR, CHAT_QUEUE_LIMIT, WORKER_CONCURRENCY, BATCH_MAX_LINKS
+import job_queue
+from job_queue import stage, track_files
+import result_cache
+import singleflight
+import instagram_session
+import job_store
+import janitor
+import metrics
+from rate_limiter import STATUS
+from progress import StatusMessage, download_progress, processing_progress
+from instagram_dl import extract_instagram_urls, download_instagram, get_shortcode, stream_plan
+from media_handler import extract_audio, extract_audio_from_stream
+from pipeline import optimize_async, io_async, fetch_async, callback_async
+from telegram_sender import (send_message, send_photo, send_audio, send_video_with_button, answer_callback,
+                             send_video_by_file_id, send_photo_by_file_id, send_audio_by_file_id, get_file_id, download_file,
+                             get_file_size, fits_get_file,
+                             send_media_group, media_audio_keyboard, send_streamed_item, stream_file, edit_message_text,
+                             MEDIA_GROUP_LIMIT)
+
+logger = logging.getLogger(__name__)
+
+queue_status = {}
+queue_status_locks = {}
+queue_status_guard = threading.Lock()
+started = False
+start_lock = threading.Lock()
+
+def cleanup_user_audio(chat_id):
+    for audio_id, path in job_store.chat_audio(chat_id):
+        if job_store.pop_audio(audio_id, path) and os.path.exists(path):
+            os.remove(path)
+            logger.info(f'Cleaned up user audio: {audio_id}')
+
+def acknowledge_callback(callback_query):
+    # Answered while the update is accepted, not once a worker is free, so
+    # the button stops spinning and the retained video's lease is extended
+    # before the janitor can expire it.
+    data = callback_query.get('data', '')
+    if data.startswith('audio:'):
+        job_store.extend_audio(data.split(':', 1)[1], AUDIO_CACHE_TIMEOUT)
+        answer_callback(callback_query['id'], 'Preparing audio...')
+    elif data.startswith('noaudio:'):
+        answer_callback(callback_query['id'], 'Deleted from server')
+    else:
+        answer_callback(callback_query['id'])
+
+def accept_update(data):
+    if 'callback_query' in data:
+        acknowledge_callback(data['callback_query'])
+        callback_async(run_callback, data['callback_query'])
+        return 'queued'
+    
+    status, ahead = job_queue.submit(data)
+    if status == 'full':
+        return status
+    
+    chat_id = job_queue.update_chat_id(data)
+    if status == 'chat_full':
+        io_async(send_message, chat_id, f'You already have {CHAT_QUEUE_LIMIT} links waiting. Send more once they are done.')
+    elif ahead and is_link_update(data):
+        io_async(show_queue_position, chat_id, ahead)
+    return status
+
+def message_links(message):
+    text = message.get('text') or message.get('caption') or ''
+    entities = message.get('entities') or message.get('caption_entities')
+    return extract_instagram_urls(text, entities)
+
+def is_link_update(data):
+    return bool(message_links(data.get('message', {})))
+
+def queue_status_lock(chat_id):
+    with queue_status_guard:
+        return queue_status_locks.setdefault(chat_id, threading.Lock())
+
+def show_queue_position(chat_id, position):
+    text = f'Queued (position {position})'
+    with queue_status_lock(chat_id):
+        # This runs on the io pool and can lose the race with the worker. If
+        # nothing is waiting any more, the job that would take the notice has
+        # already looked, so sending it now would leave it behind for good.
+        if not job_queue.waiting(chat_id):
+            return
+        message_id = queue_status.get(chat_id)
+        if message_id:
+            edit_message_text(chat_id, message_id, text)
+            return
+        response = send_message(chat_id, text, priority=STATUS)
+        if response and response.get('ok'):
+            queue_status[chat_id] = response['result']['message_id']
+
+def take_queue_status(chat_id):
+    with queue_status_lock(chat_id):
+        remaining = job_queue.waiting(chat_id)
+        message_id = queue_status.get(chat_id)
+        if not message_id:
+            return None
+        if remaining:
+            edit_message_text(chat_id, message_id, f'Queued (position {remaining})')
+            return None
+        del queue_status[chat_id]
+    with queue_status_guard:
+        queue_status_locks.pop(chat_id, None)
+    return message_id
+
+def handle_update(data):
+    if 'callback_query' in data:
+        handle_callback_query(data['callback_query'])
+        return
+    
+    if 'message' not in data:
+        return
+    
+    message = data['message']
+    chat_id = message['chat']['id']
+    text = message.get('text')
+    links = message_links(message)
+    
+    if text == '/start':
+        msg = 'Hello AXIOM Instagram Studio Bot. \nSend Instagram link (reel/post/carousel).\nFeatures:\nSmart compression\nAudio extraction\nAuto cleanup.'
+        send_message(chat_id, msg)
+    
+    elif links:
+        if not job_store.acquire_chat(chat_id):
+            raise job_queue.Deferred()
+        try:
+            if len(links) == 1:
+                process_link(chat_id, links[0])
+            else:
+                process_batch(chat_id, links)
+        finally:
+            job_store.release_chat(chat_id)
+    
+    elif text is not None:
+        send_message(chat_id, 'Send me an Instagram link (reel/post/carousel).')
+
+def send_items(chat_id, items):
+    if len(items) == 1:
+        item = items[0]
+        if item.get('chunks'):
+            return [send_streamed_item(chat_id, item)]
+        if item['type'] == 'video':
+            if item.get('file_id'):
+                return [send_video_by_file_id(chat_id, item['file_id'], item.get('caption'), item.get('video_id'))]
+            return [send_video_with_button(chat_id, item['path'], item.get('caption'), item.get('video_id'))]
+        if item.get('file_id'):
+            return [send_photo_by_file_id(chat_id, item['file_id'], item.get('caption'))]
+        return [send_photo(chat_id, item['path'], item.get('caption'))]
+    
+    responses = send_media_group(chat_id, items)
+    video_ids = [(idx + 1, item['video_id']) for idx, item in enumerate(items) if item['type'] == 'video' and item.get('video_id')]
+    if video_ids:
+        send_message(chat_id, 'Audio for videos in this post:', media_audio_keyboard(video_ids))
+    return responses
+
+def send_cached_result(chat_id, cached):
+    send_items(chat_id, cached['items'])
+
+def process_link(chat_id, text):
+    cleanup_user_audio(chat_id)
+    status = StatusMessage(chat_id, take_queue_status(chat_id))
+    
+    shortcode = get_shortcode(text)
+    cached = result_cache.get(shortcode)
+    if cached:
+        with stage('upload'):
+            send_cached_result(chat_id, cached)
+        status.finish('Done!')
+        return
+    
+    status.update('Downloading from Instagram...', force=True)
+    
+    shared_result, shared = singleflight.do(shortcode, deliver_fresh, chat_id, text, shortcode, status)
+    
+    if shared:
+        if shared_result and shared_result['items']:
+            status.update('Uploading...', force=True)
+            with stage('upload'):
+                send_cached_result(chat_id, shared_result)
+            status.finish('Done!')
+        else:
+            status.finish('Download failed. Instagram may be blocking requests. Wait 5-10 minutes and try again.')
+
+def uploaded_size(item, response):
+    size = get_file_size(response, item['type'])
+    if not size and item.get('path') and os.path.exists(item['path']):
+        size = os.path.getsize(item['path'])
+    return size
+
+def collect_sent_items(items, responses):
+    sent_items = []
+    for item, response in zip(items, responses):
+        file_id = get_file_id(response, item['type'])
+        if not file_id:
+            continue
+        sent_item = {'type': item['type'], 'file_id': file_id, 'caption': item['caption']}
+        if item['type'] == 'video':
+            sent_item['video_id'] = item['video_id']
+            if fits_get_file(uploaded_size(item, response)):
+                result_cache.put_video(item['video_id'], file_id)
+        sent_items.append(sent_item)
+    return sent_items
+
+def streamed_items(plan):
+    caption = plan['caption']
+    items = []
+    for idx, entry in enumerate(plan['items']):
+        if entry['type'] == 'video':
+            item_caption = caption if idx == 0 else f'Part {idx+1}'
+            items.append({'type': 'video', 'chunks': entry['chunks'], 'filename': f'{entry["name"]}.mp4',
+                          'caption': item_caption, 'video_id': entry['name']})
+        else:
+            items.append({'type': 'photo', 'chunks': entry['chunks'], 'filename': f'{entry["name"]}.jpg',
+                          'caption': caption if idx == 0 else None})
+    return items
+
+def deliver_streamed(chat_id, shortcode, plan, status):
+    caption = plan['caption']
+    items = streamed_items(plan)
+    
+    status.update('Uploading...', force=True)
+    with stage('upload'):
+        responses = send_items(chat_id, items)
+    
+    sent_items = collect_sent_items(items, responses)
+    if not sent_items:
+        logger.warning(f'Streaming upload failed for {shortcode}, falling back to download')
+        return None
+    
+    if len(sent_items) == len(items):
+        result_cache.put(shortcode, caption, sent_items)
+    else:
+        status.note(f'Only {len(sent_items)} of {len(items)} item(s) were sent.')
+    
+    status.finish('Done!')
+    return {'caption': caption, 'items': sent_items}
+
+def deliver_fresh(chat_id, text, shortcode, status):
+    with stage('download'):
+        plan, metadata = stream_plan(text)
+    
+    if plan:
+        delivered = deliver_streamed(chat_id, shortcode, plan, status)
+        if delivered:
+            metrics.inc('download_source_total', source='stream')
+            return delivered
+    
+    with stage('download'):
+        result = download_instagram(text, metadata, download_progress(status))
+    
+    if result and result.get('files'):
+        track_files(result['files'])
+    
+    if not result:
+        status.finish('Download failed. Instagram may be blocking requests. Wait 5-10 minutes and try again.')
+        return None
+    
+    if not result['success']:
+        status.finish('This post is too large to send through Telegram.')
+        return None
+    
+    files = result.get('files', [])
+    caption = result.get('caption', '')
+    
+    if not files:
+        status.finish('No media found.')
+        return None
+    
+    status.update(f'Processing {len(files)} file(s)...', force=True)
+    item_progress = processing_progress(status, len(files))
+    
+    prepared = []
+    responses = []
+    pending_upload = None
+    complete = True
+    
+    optimizations = [start_optimize(file_path, item_progress(idx)) for idx, file_path in enumerate(files)]
+    
+    for start in range(0, len(files), MEDIA_GROUP_LIMIT):
+        chunk = []
+        for idx in range(start, min(start + MEDIA_GROUP_LIMIT, len(files))):
+            item = finish_item(status, idx, files[idx], caption, optimizations[idx])
+            if item:
+                chunk.append(item)
+            else:
+                complete = False
+        
+        if chunk:
+            if pending_upload:
+                responses.extend(pending_upload.result())
+                pending_upload = None
+            prepared.extend(chunk)
+            track_files([item['path'] for item in chunk])
+            if start + MEDIA_GROUP_LIMIT < len(files):
+                pending_upload = io_async(timed_send_items, chat_id, chunk)
+            else:
+                # The last chunk has nothing left to overlap with, so it goes
+                # out on the job thread instead of queueing for the io pool.
+                responses.extend(timed_send_items(chat_id, chunk))
+    
+    if pending_upload:
+        responses.extend(pending_upload.result())
+    
+    sent_items = collect_sent_items(prepared, responses)
+    if len(sent_items) < len(prepared):
+        complete = False
+    
+    retain_videos(chat_id, prepared)
+    
+    if complete:
+        result_cache.put(shortcode, caption, sent_items)
+    
+    status.finish('Done! Click audio button within 2 minutes if needed.')
+    return {'caption': caption, 'items': sent_items}
+
+def retain_videos(chat_id, items):
+    for item in items:
+        if item['type'] == 'video':
+            job_store.register_audio(item['video_id'], item['path'], chat_id, AUDIO_CACHE_TIMEOUT)
+            janitor.schedule_audio_expiry(item['video_id'], item['path'], AUDIO_CACHE_TIMEOUT)
+        elif os.path.exists(item['path']):
+            os.remove(item['path'])
+
+def prepare_post(url, status, label):
+    shortcode = get_shortcode(url)
+    post = {'url': url, 'shortcode': shortcode, 'label': label}
+    cached = result_cache.get(shortcode)
+    if cached:
+        return dict(post, caption=cached['caption'], items=cached['items'], source='cache')
+    
+    with stage('download'):
+        plan, metadata = stream_plan(url)
+    if plan:
+        metrics.inc('download_source_total', source='stream')
+        return dict(post, caption=plan['caption'], items=streamed_items(plan), source='stream', metadata=metadata)
+    return download_post(post, metadata, status)
+
+def download_post(post, metadata, status):
+    label = post['label']
+    with stage('download'):
+        result = download_instagram(post['url'], metadata)
+    if result and result.get('files'):
+        track_files(result['files'])
+    if not result or not result['success'] or not result.get('files'):
+        if result and not result['success']:
+            status.note(f'{label}: too large to send through Telegram.')
+        else:
+            status.note(f'{label}: download failed.')
+        return None
+    
+    files = result['files']
+    caption = result.get('caption', '')
+    optimizations = [start_optimize(file_path) for file_path in files]
+    items = [finish_item(status, idx, file_path, caption, optimization, f'{label}: ')
+             for idx, file_path, optimization in zip(range(len(files)), files, optimizations)]
+    prepared = [item for item in items if item]
+    track_files([item['path'] for item in prepared])
+    return dict(post, caption=caption, items=prepared, source='download', complete=len(prepared) == len(files))
+
+def send_posts(chat_id, posts, status):
+    items = [item for post in posts for item in post['items']]
+    with stage('upload'):
+        responses = send_items(chat_id, items)
+    
+    start = 0
+    failed_streams = []
+    for post in posts:
+        post_items = post['items']
+        post_responses = responses[start:start + len(post_items)]
+        start += len(post_items)
+        sent_items = collect_sent_items(post_items, post_responses)
+        if post['source'] == 'stream' and not sent_items:
+            failed_streams.append(post)
+            continue
+        if len(sent_items) < len(post_items):
+            status.note(f'{post["label"]}: only {len(sent_items)} of {len(post_items)} item(s) were sent.')
+        elif post['source'] != 'cache' and post.get('complete', True):
+            result_cache.put(post['shortcode'], post['caption'], sent_items)
+        if post['source'] == 'download':
+            retain_videos(chat_id, post_items)
+    return failed_streams
+
+def retry_streamed_posts(chat_id, posts, status):
+    logger.warning(f'Streaming upload failed for {len(posts)} batch post(s), falling back to download')
+    status.update('Retrying failed uploads...', force=True)
+    futures = [fetch_async(download_post, post, post['metadata'], status) for post in posts]
+    retried = []
+    for post, future in zip(posts, futures):
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error(f'Batch fetch error: {e}')
+            status.note(f'{post["label"]}: download failed.')
+            continue
+        if result and result['items']:
+            retried.append(result)
+    
+    if retried:
+        for post in send_posts(chat_id, retried, status):
+            status.note(f'{post["label"]}: upload failed.')
+    return retried
+
+def process_batch(chat_id, links):
+    cleanup_user_audio(chat_id)
+    status = StatusMessage(chat_id, take_queue_status(chat_id))
+    if len(links) > BATCH_MAX_LINKS:
+        status.note(f'Only the first {BATCH_MAX_LINKS} links were fetched.')
+        links = links[:BATCH_MAX_LINKS]
+    
+    status.update(f'Fetching {len(links)} posts...', force=True)
+    futures = {fetch_async(prepare_post, url, status, f'Post {number}'): number - 1
+               for number, url in enumerate(links, 1)}
+    posts = [None] * len(links)
+    for done, future in enumerate(as_completed(futures), 1):
+        try:
+            posts[futures[future]] = future.result()
+        except Exception as e:
+            logger.error(f'Batch fetch error: {e}')
+            status.note(f'Post {futures[future] + 1}: download failed.')
+        status.update(f'Fetched {done}/{len(links)} posts...')
+    
+    posts = [post for post in posts if post and post['items']]
+    if not posts:
+        status.finish('Download failed. Instagram may be blocking requests. Wait 5-10 minutes and try again.')
+        return
+    
+    status.update('Uploading...', force=True)
+    failed_streams = send_posts(chat_id, posts, status)
+    if failed_streams:
+        posts += retry_streamed_posts(chat_id, failed_streams, status)
+    
+    kept_videos = any(post['source'] == 'download' and any(item['type'] == 'video' for item in post['items'])
+                      for post in posts)
+    status.finish('Done! Click audio button within 2 minutes if needed.' if kept_videos else 'Done!')
+
+def media_kind(file_path):
+    ext = file_path.split('.')[-1].lower()
+    return 'video' if ext in ['mp4', 'mov', 'webm'] else 'photo'
+
+def start_optimize(file_path, progress=None):
+    if not os.path.exists(file_path):
+        return None
+    return optimize_async(file_path, media_kind(file_path), progress)
+
+def timed_send_items(chat_id, items):
+    with stage('upload'):
+        return send_items(chat_id, items)
+
+def finish_item(status, idx, file_path, caption, optimization, note_prefix=''):
+    if optimization is None:
+        return None
+    
+    try:
+        with stage('optimize'):
+            optimized, size = optimization.result()
+    except Exception as e:
+        logger.error(f'Optimize error: {e}')
+        optimized = None
+    
+    if media_kind(file_path) == 'video':
+        if not optimized:
+            status.note(f'{note_prefix}Video {idx+1} too large even after compression.')
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            return None
+        
+        video_id = os.path.basename(optimized).replace('.mp4', '').replace('_compressed', '')
+        item_caption = caption if idx == 0 else f'Part {idx+1}'
+        return {'type': 'video', 'path': optimized, 'caption': item_caption, 'video_id': video_id}
+    
+    if not optimized:
+        status.note(f'{note_prefix}Photo {idx+1} too large.')
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        return None
+    
+    return {'type': 'photo', 'path': optimized, 'caption': caption if idx == 0 else None}
+
+def run_callback(callback_query):
+    try:
+        handle_callback_query(callback_query)
+    except Exception as e:
+        logger.error(f'Callback error: {e}')
+
+def handle_callback_query(callback_query):
+    chat_id = callback_query['message']['chat']['id']
+    data = callback_query['data']
+    
+    if data.startswith('audio:'):
+        video_id = data.split(':', 1)[1]
+        
+        audio_file_id = result_cache.get_audio(video_id)
+        if audio_file_id:
+            send_audio_by_file_id(chat_id, audio_file_id, f'{video_id} Audio')
+            return
+        
+        target_path = f'{TEMP_DIR}/{video_id}_audio.{AUDIO_FORMAT}'
+        audio_path = None
+        video_path = None
+        downloaded = False
+        cached_data = job_store.get_audio(video_id)
+        if cached_data and os.path.exists(cached_data[0]):
+            video_path = cached_data[0]
+        else:
+            video_file_id = result_cache.get_video(video_id)
+            if not video_file_id:
+                send_message(chat_id, 'Audio expired. Please resend link.')
+                return
+            
+            open_chunks = stream_file(video_file_id)
+            if open_chunks:
+                with stage('audio'):
+                    audio_path = extract_audio_from_stream(open_chunks, target_path)
+            if not audio_path:
+                with stage('download'):
+                    video_path = download_file(video_file_id, f'{TEMP_DIR}/{video_id}_ref.mp4')
+                downloaded = video_path is not None
+        
+        if video_path:
+            with stage('audio'):
+                audio_path = extract_audio(video_path, target_path)
+        
+        if downloaded and os.path.exists(video_path):
+            os.remove(video_path)
+        
+        if not audio_path:
+            send_message(chat_id, 'Could not extract audio from this video.')
+            return
+        
+        with stage('upload'):
+            response = send_audio(chat_id, audio_path, f'{video_id} Audio')
+        result_cache.put_audio(video_id, get_file_id(response, 'audio'))
+        
+        if os.path.exists(audio_path):
+            os.remove(audio_path)
+    
+    elif data.startswith('noaudio:'):
+        video_id = data.split(':', 1)[1]
+        
+        cached_data = job_store.pop_audio(video_id)
+        
+        if cached_data:
+            video_path, owner_chat_id = cached_data
+            if os.path.exists(video_path):
+                os.remove(video_path)
+                logger.info(f'User declined audio: {video_id}')
+
+def recover_jobs():
+    try:
+        resumed, failed = job_store.recover()
+    except Exception as e:
+        logger.error(f'Job recovery error: {e}')
+        return
+    for job in failed:
+        if job['chat_id']:
+            send_message(job['chat_id'], 'Sorry, your last request was interrupted. Please send the link again.')
+    job_queue.resume(resumed)
+
+def start(concurrency=WORKER_CONCURRENCY):
+    global started
+    with start_lock:
+        if started:
+            return
+        started = True
+    instagram_session.init_sessions()
+    janitor.start(recover_jobs)
+    job_queue.start_workers(handle_update, concurrency)
@@ -1,18 +1,31 @@
 import os
+import re
+import time
 import logging
-import base64
+import threading
+import requests
 import yt_dlp
-from instagrapi import Client
-from config import COOKIE_BASE64, TEMP_DIR
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+import metrics
+import instagram_session
+from job_queue import stage, current_job
+from config import TEMP_DIR, GET_FILE_MAX_SIZE_MB, MAX_SOURCE_SIZE_MB, INSTAGRAM_DOWNLOAD_FANOUT, INSTAGRAM_DOWNLOAD_DEADLINE
 
 logger = logging.getLogger(__name__)
 
-def is_instagram_url(text):
-    text = text.strip()
-    if 'instagram.com' in text or 'instagr.am' in text:
-        if '/p/' in text or '/reel/' in text or '/tv/' in text:
-            return True
-    return False
+INSTAGRAM_URL_PATTERN = re.compile(
+    r'(?:https?://)?(?:www\.|m\.)?(?:instagram\.com|instagr\.am)/(?:[A-Za-z0-9_.]+/)?(p|reels?|tv)/(?!audio/)([A-Za-z0-9_-]+)',
+    re.IGNORECASE
+)
+
+CHUNK_SIZE = 256 * 1024
+RESOURCE_ATTEMPTS = 3
+
+cdn_session = requests.Session()
+cdn_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=INSTAGRAM_DOWNLOAD_FANOUT * 2)
+cdn_session.mount('https://', cdn_adapter)
+cdn_session.mount('http://', cdn_adapter)
 
 def get_shortcode(url):
     parts = url.split('/')
@@ -21,113 +34,314 @@ def get_shortcode(url):
             return parts[i + 1].split('?')[0]
     return None
 
-def download_with_ytdlp(url):
-    cookie_file = None
-    try:
-        if COOKIE_BASE64:
-            cookie_file = f'{TEMP_DIR}/cookies.txt'
-            cookie_content = base64.b64decode(COOKIE_BASE64).decode('utf-8')
-            with open(cookie_file, 'w') as f:
-                f.write(cookie_content)
-        
+def extract_instagram_urls(text, entities=None):
+    sources = [text or '']
+    sources += [entity['url'] for entity in entities or [] if entity.get('type') == 'text_link' and entity.get('url')]
+    urls = {}
+    for source in sources:
+        for kind, shortcode in INSTAGRAM_URL_PATTERN.findall(source):
+            kind = 'reel' if kind.lower().startswith('reel') else kind.lower()
+            urls.setdefault(shortcode, f'https://www.instagram.com/{kind}/{shortcode}/')
+    return list(urls.values())
+
+class YtdlpLogger:
+    def debug(self, msg):
+        logger.debug(msg)
+    
+    def info(self, msg):
+        logger.debug(msg)
+    
+    def warning(self, msg):
+        logger.warning(f'yt-dlp: {msg}')
+    
+    def error(self, msg):
+        logger.error(f'yt-dlp: {msg}')
+
+ydl_local = threading.local()
+
+def ytdlp_progress_hook(d):
+    progress = getattr(ydl_local, 'progress', None)
+    if progress and d.get('status') == 'downloading':
+        progress(d.get('downloaded_bytes') or 0, d.get('total_bytes') or d.get('total_bytes_estimate'))
+
+def get_ydl():
+    ydl = getattr(ydl_local, 'ydl', None)
+    if ydl is None:
+        instagram_session.init_sessions()
         ydl_opts = {
             'format': 'best[filesize<50M]/best',
             'outtmpl': f'{TEMP_DIR}/%(id)s.%(ext)s',
-            'quiet': False,
-            'no_warnings': False
+            'quiet': True,
+            'no_warnings': True,
+            'noprogress': True,
+            'logger': YtdlpLogger(),
+            'progress_hooks': [ytdlp_progress_hook]
         }
+        if instagram_session.cookie_path:
+            ydl_opts['cookiefile'] = instagram_session.cookie_path
+        ydl = yt_dlp.YoutubeDL(ydl_opts)
+        ydl_local.ydl = ydl
+    return ydl
+
+def job_prefix():
+    # A batch and a single link (or two batches) can fetch the same post at
+    # once, so each job downloads into file names of its own.
+    job = current_job()
+    return f'j{job["db_id"]}_' if job else ''
+
+def ytdlp_entries(info):
+    if 'entries' in info:
+        return [entry for entry in info['entries'] or [] if entry]
+    return [info]
+
+def fetch_metadata(url):
+    start = time.time()
+    with stage('ytdlp_metadata'):
+        info = get_ydl().extract_info(url, download=False)
+    entries = ytdlp_entries(info)
+    size_bytes = sum(entry.get('filesize') or entry.get('filesize_approx') or 0 for entry in entries)
+    logger.info(f'yt-dlp metadata for {info.get("id")} in {time.time() - start:.2f}s ({len(entries)} item(s), ~{size_bytes / (1024 * 1024):.1f} MB)')
+    return {
+        'id': info.get('id'),
+        'info': info,
+        'entries': entries,
+        'size_mb': size_bytes / (1024 * 1024)
+    }
+
+def format_ytdlp_caption(info):
+    username = info.get('uploader_id', '') or info.get('uploader', '') or info.get('channel', '')
+    caption_text = info.get('description', '')
+    track_name = info.get('track', '')
+    artist_name = info.get('artist', '')
+    
+    formatted_caption = ''
+    
+    if username:
+        clean_username = username.replace('@', '').strip()
+        formatted_caption = f'@{clean_username}'
+    
+    if caption_text:
+        clean_text = caption_text.strip()
+        if len(clean_text) > 400:
+            clean_text = clean_text[:400] + '...'
+        formatted_caption += f'{clean_text}'
+    
+    if track_name or artist_name:
+        music_info = f'🎵 {track_name}' if track_name else ''
+        if artist_name:
+            music_info += f' - {artist_name}' if track_name else f'🎵 {artist_name}'
+        formatted_caption += music_info
+    
+    return formatted_caption.strip(), username
+
+def download_with_ytdlp(url, metadata=None, progress=None):
+    ydl_local.progress = progress
+    try:
+        if metadata is None:
+            metadata = fetch_metadata(url)
         
-        if cookie_file:
-            ydl_opts['cookiefile'] = cookie_file
+        if metadata['size_mb'] > MAX_SOURCE_SIZE_MB:
+            logger.warning(f'Skipping {metadata["id"]}: ~{metadata["size_mb"]:.0f} MB exceeds {MAX_SOURCE_SIZE_MB} MB')
+            return {'success': False, 'error': 'too_large'}
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            filename = ydl.prepare_filename(info)
-            
-            username = info.get('uploader_id', '') or info.get('uploader', '') or info.get('channel', '')
-            caption_text = info.get('description', '')
-            track_name = info.get('track', '')
-            artist_name = info.get('artist', '')
-            
-            formatted_caption = ''
-            
-            if username:
-                clean_username = username.replace('@', '').strip()
-                formatted_caption = f'@{clean_username}'
-            
-            if caption_text:
-                clean_text = caption_text.strip()
-                if len(clean_text) > 400:
-                    clean_text = clean_text[:400] + '...'
-                formatted_caption += f'{clean_text}'
-            
-            if track_name or artist_name:
-                music_info = f'🎵 {track_name}' if track_name else ''
-                if artist_name:
-                    music_info += f' - {artist_name}' if track_name else f'🎵 {artist_name}'
-                formatted_caption += music_info
-            
-            media_type = 'video'
-            
-            if cookie_file and os.path.exists(cookie_file):
-                os.remove(cookie_file)
-            
-            return {
-                'success': True,
-                'files': [filename],
-                'media_type': media_type,
-                'caption': formatted_caption.strip(),
-                'username': username
-            }
+        ydl = get_ydl()
+        ydl.params['outtmpl']['default'] = f'{TEMP_DIR}/{job_prefix()}%(id)s.%(ext)s'
+        files = []
+        start = time.time()
+        with stage('ytdlp_download'):
+            for entry in metadata['entries']:
+                ydl.process_info(entry)
+                files.append(ydl.prepare_filename(entry))
+        logger.info(f'yt-dlp download for {metadata["id"]} in {time.time() - start:.2f}s')
+        
+        caption, username = format_ytdlp_caption(metadata['entries'][0] if 'entries' in metadata['info'] else metadata['info'])
+        
+        return {
+            'success': True,
+            'files': files,
+            'media_type': 'video',
+            'caption': caption,
+            'username': username,
+            'is_carousel': len(files) > 1
+        }
     except Exception as e:
         logger.error(f'yt-dlp error: {e}')
-        if cookie_file and os.path.exists(cookie_file):
-            os.remove(cookie_file)
         return None
+    finally:
+        ydl_local.progress = None
+
+def fetch_resource(url, dest_path, deadline, on_bytes=None):
+    downloaded = 0
+    for attempt in range(RESOURCE_ATTEMPTS):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        headers = {'Range': f'bytes={downloaded}-'} if downloaded else {}
+        try:
+            with cdn_session.get(url, headers=headers, stream=True, timeout=(10, min(remaining, 60))) as response:
+                response.raise_for_status()
+                if downloaded and response.status_code != 206:
+                    downloaded = 0
+                expected = downloaded + int(response.headers.get('Content-Length') or 0)
+                with open(dest_path, 'ab' if downloaded else 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+                        downloaded += len(chunk)
+                        if on_bytes:
+                            on_bytes(len(chunk))
+                        if time.time() > deadline:
+                            raise TimeoutError('download deadline exceeded')
+            if downloaded >= expected:
+                return dest_path
+            logger.warning(f'Incomplete download of {dest_path} ({downloaded}/{expected} bytes), resuming')
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            logger.warning(f'Resource download interrupted at {downloaded} bytes, resuming: {e}')
+        except Exception as e:
+            logger.error(f'Resource download error: {e}')
+            break
+    
+    if os.path.exists(dest_path):
+        os.remove(dest_path)
+    return None
+
+def fetch_resources(resources, progress=None):
+    deadline = time.time() + INSTAGRAM_DOWNLOAD_DEADLINE
+    totals = {'bytes': 0}
+    totals_lock = threading.Lock()
+    
+    def on_bytes(count):
+        with totals_lock:
+            totals['bytes'] += count
+            done = totals['bytes']
+        if progress:
+            progress(done)
+    
+    with ThreadPoolExecutor(max_workers=INSTAGRAM_DOWNLOAD_FANOUT) as pool:
+        futures = [pool.submit(fetch_resource, url, dest_path, deadline, on_bytes) for url, dest_path in resources]
+        return [future.result() for future in futures]
 
-def download_with_instagrapi(url):
+def media_resources(media_info, shortcode):
+    if media_info.media_type == 8:
+        items = media_info.resources
+    else:
+        items = [media_info]
+    
+    prefix = job_prefix()
+    resources = []
+    for idx, item in enumerate(items):
+        if item.media_type == 2 and item.video_url:
+            resources.append((str(item.video_url), f'{TEMP_DIR}/{prefix}{shortcode}_{idx}.mp4'))
+        elif item.media_type == 1 and item.thumbnail_url:
+            resources.append((str(item.thumbnail_url), f'{TEMP_DIR}/{prefix}{shortcode}_{idx}.jpg'))
+    return resources
+
+def format_instagrapi_caption(media_info):
+    username = media_info.user.username if media_info.user else ''
+    caption_text = media_info.caption_text if media_info.caption_text else ''
+    
+    formatted_caption = ''
+    if username:
+        formatted_caption = f'@{username}'
+    if caption_text:
+        clean_text = caption_text.strip()
+        if len(clean_text) > 400:
+            clean_text = clean_text[:400] + '...'
+        formatted_caption += clean_text
+    return formatted_caption.strip()
+
+def stream_chunks(url, headers=None):
+    def open_chunks():
+        with cdn_session.get(url, headers=headers or {}, stream=True, timeout=(10, 60)) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                yield chunk
+    return open_chunks
+
+def is_streamable_video(entry):
+    # Streamed videos keep no local copy, so the audio button relies on
+    # getFile, which stops at 20 MB; larger videos take the download path.
+    vcodec = entry.get('vcodec') or ''
+    acodec = entry.get('acodec') or ''
+    size = entry.get('filesize') or entry.get('filesize_approx') or 0
+    return bool(
+        entry.get('url')
+        and not entry.get('requested_formats')
+        and entry.get('ext') == 'mp4'
+        and (entry.get('protocol') or 'https').startswith('http')
+        and (vcodec.startswith('avc1') or vcodec == 'h264')
+        and (acodec.startswith('mp4a') or acodec == 'aac')
+        and 0 < size <= GET_FILE_MAX_SIZE_MB * 1024 * 1024
+    )
+
+def stream_plan(url):
+    shortcode = get_shortcode(url)
+    try:
+        metadata = fetch_metadata(url)
+    except Exception as e:
+        logger.info(f'yt-dlp metadata unavailable, checking for photos: {e}')
+        metadata = False
+    
+    if metadata:
+        entries = metadata['entries']
+        if not entries or not all(is_streamable_video(entry) for entry in entries):
+            return None, metadata
+        info = entries[0] if 'entries' in metadata['info'] else metadata['info']
+        caption, username = format_ytdlp_caption(info)
+        items = [
+            {
+                'type': 'video',
+                'name': entry.get('id') or f'{shortcode}_{idx}',
+                'chunks': stream_chunks(entry['url'], entry.get('http_headers'))
+            }
+            for idx, entry in enumerate(entries)
+        ]
+        return {'caption': caption, 'items': items}, metadata
+    
+    if not shortcode:
+        return None, metadata
+    try:
+        with instagram_session.instagram_client() as cl:
+            media_info = cl.media_info(cl.media_pk_from_code(shortcode))
+    except Exception as e:
+        logger.error(f'Instagrapi error: {e}')
+        return None, metadata
+    
+    # Hand the media info on so the download path doesn't fetch it again.
+    metadata = {'media_info': media_info}
+    resources = media_resources(media_info, shortcode)
+    if not resources or not all(path.endswith('.jpg') for _, path in resources):
+        return None, metadata
+    items = [
+        {
+            'type': 'photo',
+            'name': os.path.splitext(os.path.basename(path))[0],
+            'chunks': stream_chunks(resource_url)
+        }
+        for resource_url, path in resources
+    ]
+    return {'caption': format_instagrapi_caption(media_info), 'items': items}, metadata
+
+def download_with_instagrapi(url, progress=None, media_info=None):
     try:
-        cl = Client()
-        cl.delay_range = [1, 3]
-        
         shortcode = get_shortcode(url)
         if not shortcode:
             return None
         
-        media_pk = cl.media_pk_from_code(shortcode)
-        media_info = cl.media_info(media_pk)
+        if media_info is None:
+            with instagram_session.instagram_client() as cl:
+                media_pk = cl.media_pk_from_code(shortcode)
+                media_info = cl.media_info(media_pk)
         
         files = []
-        username = media_info.user.username if media_info.user else ''
-        caption_text = media_info.caption_text if media_info.caption_text else ''
+        formatted_caption = format_instagrapi_caption(media_info)
         
-        formatted_caption = ''
-        if username:
-            formatted_caption = f'@{username}'
-        if caption_text:
-            clean_text = caption_text.strip()
-            if len(clean_text) > 400:
-                clean_text = clean_text[:400] + '...'
-            formatted_caption += clean_text
+        resources = media_resources(media_info, shortcode)
+        for path in fetch_resources(resources, progress):
+            if path and os.path.exists(path):
+                files.append(path)
         
-        if media_info.media_type == 1:
-            photo_path = cl.photo_download(media_pk, folder=TEMP_DIR)
-            if os.path.exists(photo_path):
-                files.append(photo_path)
-        elif media_info.media_type == 2:
-            video_path = cl.video_download(media_pk, folder=TEMP_DIR)
-            if os.path.exists(video_path):
-                files.append(video_path)
-        elif media_info.media_type == 8:
-            for resource in media_info.resources:
-                if resource.media_type == 1:
-                    photo_path = cl.photo_download_by_url(resource.thumbnail_url, folder=TEMP_DIR)
-                    if os.path.exists(photo_path):
-                        files.append(photo_path)
-                elif resource.media_type == 2:
-                    video_path = cl.video_download_by_url(resource.video_url, folder=TEMP_DIR)
-                    if os.path.exists(video_path):
-                        files.append(video_path)
+        if len(files) < len(resources):
+            logger.warning(f'Fetched {len(files)} of {len(resources)} resources for {shortcode}')
         
         is_carousel = media_info.media_type == 8
         media_type = 'video' if media_info.media_type == 2 else 'photo'
@@ -136,20 +350,35 @@ def download_with_instagrapi(url):
             'success': True,
             'files': files,
             'media_type': media_type,
-            'caption': formatted_caption.strip(),
+            'caption': formatted_caption,
             'is_carousel': is_carousel
         }
     except Exception as e:
         logger.error(f'Instagrapi error: {e}')
         return None
 
-def download_instagram(url):
-    result = download_with_ytdlp(url)
-    if result and result['success']:
-        return result
+def record_download(source, result):
+    metrics.inc('download_source_total', source=source)
+    if result and result.get('files'):
+        size = sum(os.path.getsize(path) for path in result['files'] if os.path.exists(path))
+        metrics.inc('download_bytes_total', size, source=source)
+
+def download_instagram(url, metadata=None, progress=None):
+    media_info = metadata.get('media_info') if metadata else None
+    if metadata is not False and media_info is None:
+        with metrics.timed('download_seconds', source='ytdlp') as labels:
+            result = download_with_ytdlp(url, metadata, progress)
+            labels['outcome'] = 'ok' if result and result['success'] else 'error'
+        if result and (result['success'] or result.get('error') == 'too_large'):
+            record_download('ytdlp', result)
+            return result
     
-    result = download_with_instagrapi(url)
+    with metrics.timed('download_seconds', source='instagrapi') as labels:
+        result = download_with_instagrapi(url, progress, media_info)
+        labels['outcome'] = 'ok' if result and result['success'] else 'error'
     if result and result['success']:
+        record_download('instagrapi', result)
         return result
     
+    record_download('none', None)
     return None
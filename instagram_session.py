@@ -0,0 +1,178 @@
+import os
+import time
+import base64
+import logging
+import threading
+from contextlib import contextmanager
+from http.cookiejar import MozillaCookieJar
+from instagrapi import Client
+from instagrapi.exceptions import (ChallengeRequired, ClientThrottledError, FeedbackRequired, LoginRequired,
+                                   PleaseWaitFewMinutes, RateLimitError)
+import metrics
+from config import (COOKIE_BASE64, COOKIE_FILE, INSTAGRAM_SESSION_DIR, INSTAGRAM_SESSION_COUNT, INSTAGRAM_SESSION_RATE,
+                    INSTAGRAM_SESSION_COOLDOWN, INSTAGRAM_SESSION_WAIT)
+
+logger = logging.getLogger(__name__)
+
+THROTTLE_ERRORS = (ChallengeRequired, ClientThrottledError, FeedbackRequired, LoginRequired, PleaseWaitFewMinutes, RateLimitError)
+SETTINGS_SAVE_INTERVAL = 300
+
+sessions = []
+sessions_lock = threading.Condition()
+next_index = 0
+cookie_path = None
+
+def write_cookie_file():
+    if not COOKIE_BASE64:
+        return None
+    try:
+        os.makedirs(os.path.dirname(COOKIE_FILE), exist_ok=True)
+        tmp_path = f'{COOKIE_FILE}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(base64.b64decode(COOKIE_BASE64).decode('utf-8'))
+        os.replace(tmp_path, COOKIE_FILE)
+        return COOKIE_FILE
+    except Exception as e:
+        logger.error(f'Cookie file error: {e}')
+        return None
+
+def load_cookies(path):
+    if not path:
+        return {}
+    try:
+        jar = MozillaCookieJar(path)
+        jar.load(ignore_discard=True, ignore_expires=True)
+        return {cookie.name: cookie.value for cookie in jar if 'instagram' in cookie.domain}
+    except Exception as e:
+        logger.error(f'Cookie parse error: {e}')
+        return {}
+
+def settings_path(index):
+    return f'{INSTAGRAM_SESSION_DIR}/session_{index}.json'
+
+def build_session(index, cookies):
+    cl = Client()
+    cl.delay_range = [1, 3]
+    path = settings_path(index)
+    try:
+        if os.path.exists(path):
+            cl.load_settings(path)
+        elif cookies:
+            cl.set_settings({'cookies': cookies})
+    except Exception as e:
+        logger.error(f'Instagram session {index} settings error: {e}')
+    return {
+        'index': index,
+        'client': cl,
+        'busy': False,
+        'tokens': INSTAGRAM_SESSION_RATE,
+        'refilled_at': time.time(),
+        'cooldown_until': 0,
+        'saved_at': 0,
+        'requests': 0,
+        'throttled': 0
+    }
+
+def init_sessions():
+    global cookie_path
+    with sessions_lock:
+        if sessions:
+            return
+        cookie_path = write_cookie_file()
+        cookies = load_cookies(cookie_path)
+        os.makedirs(INSTAGRAM_SESSION_DIR, exist_ok=True)
+        for index in range(max(1, INSTAGRAM_SESSION_COUNT)):
+            sessions.append(build_session(index, cookies))
+        logger.info(f'Started {len(sessions)} Instagram session(s)')
+
+def refill(session, now):
+    elapsed = now - session['refilled_at']
+    session['tokens'] = min(INSTAGRAM_SESSION_RATE, session['tokens'] + elapsed * INSTAGRAM_SESSION_RATE / 60)
+    session['refilled_at'] = now
+
+def acquire(timeout=INSTAGRAM_SESSION_WAIT):
+    global next_index
+    init_sessions()
+    deadline = time.time() + timeout
+    with sessions_lock:
+        while True:
+            now = time.time()
+            for offset in range(len(sessions)):
+                session = sessions[(next_index + offset) % len(sessions)]
+                refill(session, now)
+                if session['busy'] or session['cooldown_until'] > now or session['tokens'] < 1:
+                    continue
+                session['busy'] = True
+                session['tokens'] -= 1
+                session['requests'] += 1
+                next_index = (session['index'] + 1) % len(sessions)
+                return session
+            # Waiting is pointless if no session leaves its cooldown in time.
+            if now >= deadline or min(session['cooldown_until'] for session in sessions) > deadline:
+                return None
+            sessions_lock.wait(min(1.0, deadline - now))
+
+def release(session, throttled=False):
+    with sessions_lock:
+        session['busy'] = False
+        if throttled:
+            session['throttled'] += 1
+            session['cooldown_until'] = time.time() + INSTAGRAM_SESSION_COOLDOWN
+            logger.warning(f'Instagram session {session["index"]} cooling down for {INSTAGRAM_SESSION_COOLDOWN}s')
+        sessions_lock.notify_all()
+
+def save_settings(session):
+    now = time.time()
+    if now - session['saved_at'] < SETTINGS_SAVE_INTERVAL:
+        return
+    path = settings_path(session['index'])
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        session['client'].dump_settings(tmp_path)
+        os.replace(tmp_path, path)
+        session['saved_at'] = now
+    except Exception as e:
+        logger.error(f'Instagram session {session["index"]} save error: {e}')
+
+@contextmanager
+def instagram_client():
+    session = acquire()
+    if session is None:
+        raise RuntimeError('No Instagram session available')
+    try:
+        yield session['client']
+    except THROTTLE_ERRORS:
+        release(session, throttled=True)
+        raise
+    except Exception:
+        release(session)
+        raise
+    else:
+        save_settings(session)
+        release(session)
+
+def session_stats():
+    now = time.time()
+    with sessions_lock:
+        return [
+            {
+                'index': session['index'],
+                'requests': session['requests'],
+                'throttled': session['throttled'],
+                'cooling_down': session['cooldown_until'] > now
+            }
+            for session in sessions
+        ]
+
+def collect_metrics():
+    sessions_now = session_stats()
+    return [
+        ('instagram_session_requests_total', 'counter', 'Requests made per Instagram session',
+         [({'session': session['index']}, session['requests']) for session in sessions_now]),
+        ('instagram_session_throttled_total', 'counter', 'Throttle errors per Instagram session',
+         [({'session': session['index']}, session['throttled']) for session in sessions_now]),
+        ('instagram_session_cooling_down', 'gauge', 'Whether a session is in its throttle cooldown',
+         [({'session': session['index']}, int(session['cooling_down'])) for session in sessions_now])
+    ]
+
+metrics.register_collector(collect_metrics)
@@ -0,0 +1,145 @@
+import os
+import time
+import heapq
+import logging
+import itertools
+import threading
+import job_store
+import metrics
+from config import TEMP_DIR, JANITOR_INTERVAL, TEMP_STALE_AGE, TEMP_DISK_BUDGET_MB
+
+logger = logging.getLogger(__name__)
+
+RECENT_GRACE = 120
+MEDIA_EXTENSIONS = ('.mp4', '.mov', '.webm', '.jpg', '.jpeg', '.png', '.webp', '.heic', '.m4a', '.mp3', '.part', '.ytdl')
+
+timers = []
+timers_cond = threading.Condition()
+sequence = itertools.count()
+stats = {'reclaimed_bytes': 0, 'files_removed': 0, 'budget_evictions': 0}
+stats_lock = threading.Lock()
+janitor_thread = None
+recover_hook = None
+
+def schedule_audio_expiry(video_id, path, delay):
+    with timers_cond:
+        heapq.heappush(timers, (time.time() + delay, next(sequence), video_id, path))
+        timers_cond.notify()
+
+def remove_file(path, reason):
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+    except OSError:
+        return 0
+    with stats_lock:
+        stats['reclaimed_bytes'] += size
+        stats['files_removed'] += 1
+    logger.info(f'Janitor removed {os.path.basename(path)} ({reason}, {size / (1024 * 1024):.1f} MB)')
+    return size
+
+def expire_audio(video_id, path, now):
+    if job_store.pop_expired_audio(video_id, path, now):
+        return remove_file(path, 'audio expired')
+    return 0
+
+def temp_files():
+    files = []
+    try:
+        with os.scandir(TEMP_DIR) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.lower().endswith(MEDIA_EXTENSIONS):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+    except OSError as e:
+        logger.error(f'Janitor scan error: {e}')
+    return files
+
+def sweep():
+    # Jobs left by a process that died after this one started are only
+    # picked up here, and their files stay pinned until they are.
+    if recover_hook:
+        recover_hook()
+    
+    now = time.time()
+    reclaimed = 0
+    
+    for video_id, path in job_store.expired_audio(now):
+        reclaimed += expire_audio(video_id, path, now)
+    
+    registered = {path: (video_id, expires_at) for video_id, path, expires_at in job_store.audio_paths()}
+    active = job_store.active_files()
+    files = []
+    for mtime, size, path in temp_files():
+        if path in active:
+            continue
+        if path not in registered and now - mtime > TEMP_STALE_AGE:
+            reclaimed += remove_file(path, 'stale')
+            continue
+        files.append((mtime, size, path))
+    
+    budget = TEMP_DISK_BUDGET_MB * 1024 * 1024
+    usage = sum(size for _, size, _ in files)
+    for mtime, size, path in sorted(files):
+        if usage <= budget:
+            break
+        if now - mtime < RECENT_GRACE and path not in registered:
+            continue
+        if path in registered and not job_store.pop_audio(registered[path][0], path):
+            continue
+        removed = remove_file(path, 'over disk budget')
+        if removed:
+            usage -= removed
+            reclaimed += removed
+            with stats_lock:
+                stats['budget_evictions'] += 1
+    
+    if reclaimed:
+        logger.info(f'Janitor reclaimed {reclaimed / (1024 * 1024):.1f} MB ({stats["reclaimed_bytes"] / (1024 * 1024):.1f} MB total)')
+    return reclaimed
+
+def run():
+    next_sweep = time.time()
+    while True:
+        due = []
+        with timers_cond:
+            now = time.time()
+            wait = next_sweep - now
+            if timers:
+                wait = min(wait, timers[0][0] - now)
+            if wait > 0:
+                timers_cond.wait(wait)
+            now = time.time()
+            while timers and timers[0][0] <= now:
+                due.append(heapq.heappop(timers))
+        
+        try:
+            for _, _, video_id, path in due:
+                expire_audio(video_id, path, now)
+            if now >= next_sweep:
+                sweep()
+                next_sweep = now + JANITOR_INTERVAL
+        except Exception as e:
+            logger.error(f'Janitor error: {e}')
+
+def start(recover=None):
+    global janitor_thread, recover_hook
+    with timers_cond:
+        recover_hook = recover
+        if janitor_thread is None:
+            janitor_thread = threading.Thread(target=run, name='janitor', daemon=True)
+            janitor_thread.start()
+
+def collect_metrics():
+    usage = sum(size for _, size, _ in temp_files())
+    with stats_lock:
+        return [
+            ('temp_disk_bytes', 'gauge', 'Media bytes currently in TEMP_DIR', [({}, usage)]),
+            ('temp_disk_budget_bytes', 'gauge', 'Configured TEMP_DIR budget', [({}, TEMP_DISK_BUDGET_MB * 1024 * 1024)]),
+            ('janitor_reclaimed_bytes_total', 'counter', 'Bytes removed by the janitor', [({}, stats['reclaimed_bytes'])]),
+            ('janitor_files_removed_total', 'counter', 'Files removed by the janitor', [({}, stats['files_removed'])]),
+            ('janitor_budget_evictions_total', 'counter', 'Files evicted to stay under the disk budget',
+             [({}, stats['budget_evictions'])])
+        ]
+
+metrics.register_collector(collect_metrics)
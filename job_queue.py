@@ -0,0 +1,213 @@
+import time
+import logging
+import itertools
+import threading
+from collections import deque
+from contextlib import contextmanager
+import job_store
+import metrics
+from config import WORKER_CONCURRENCY, JOB_QUEUE_SIZE, CHAT_QUEUE_LIMIT
+
+logger = logging.getLogger(__name__)
+
+DEFER_DELAY = 2
+
+lanes = {}
+ready = deque()
+running = set()
+lanes_cond = threading.Condition()
+queued_total = 0
+job_ids = itertools.count(1)
+workers = []
+workers_lock = threading.Lock()
+local = threading.local()
+
+class Deferred(Exception):
+    pass
+
+def current_job():
+    return getattr(local, 'job', None)
+
+def bind(fn):
+    job = current_job()
+    def run(*args, **kwargs):
+        previous = current_job()
+        local.job = job
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            local.job = previous
+    return run
+
+def update_chat_id(payload):
+    if 'callback_query' in payload:
+        return payload['callback_query'].get('message', {}).get('chat', {}).get('id')
+    return payload.get('message', {}).get('chat', {}).get('id')
+
+def lane_key(chat_id, payload):
+    if 'callback_query' in payload:
+        return f'callback:{chat_id}'
+    return chat_id
+
+def heartbeat(job, name):
+    try:
+        job_store.heartbeat(job['db_id'], job['chat_id'], name)
+    except Exception as e:
+        logger.error(f'Job heartbeat error: {e}')
+
+def track_files(paths):
+    job = current_job()
+    if job is None:
+        return
+    try:
+        job_store.track_files(job['db_id'], paths)
+    except Exception as e:
+        logger.error(f'Job file tracking error: {e}')
+
+@contextmanager
+def stage(name):
+    job = current_job()
+    if job is not None:
+        heartbeat(job, name)
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        metrics.timing('job_stage_seconds', elapsed, stage=name)
+        if job is not None:
+            job['timings'][name] = job['timings'].get(name, 0) + elapsed
+
+def enqueue(db_id, chat_id, payload):
+    global queued_total
+    job = {
+        'id': next(job_ids),
+        'db_id': db_id,
+        'chat_id': chat_id,
+        'lane': lane_key(chat_id, payload),
+        'payload': payload,
+        'enqueued_at': time.time(),
+        'timings': {}
+    }
+    with lanes_cond:
+        if queued_total >= JOB_QUEUE_SIZE:
+            return 'full', 0
+        lane = lanes.setdefault(job['lane'], deque())
+        if len(lane) >= CHAT_QUEUE_LIMIT:
+            return 'chat_full', len(lane)
+        ahead = len(lane) + (1 if job['lane'] in running else 0)
+        lane.append(job)
+        queued_total += 1
+        if job['lane'] not in running and job['lane'] not in ready:
+            ready.append(job['lane'])
+        lanes_cond.notify()
+    return 'queued', ahead
+
+def submit(payload):
+    if queued_total >= JOB_QUEUE_SIZE:
+        logger.warning(f'Job queue full ({JOB_QUEUE_SIZE}), rejecting update')
+        return 'full', 0
+    chat_id = update_chat_id(payload)
+    db_id = job_store.create_job(payload, chat_id)
+    status, ahead = enqueue(db_id, chat_id, payload)
+    if status != 'queued':
+        job_store.finish_job(db_id)
+        logger.warning(f'Rejecting update for chat {chat_id}: {status}')
+    return status, ahead
+
+def resume(recovered):
+    for job in recovered:
+        status, ahead = enqueue(job['id'], job['chat_id'], job['payload'])
+        if status != 'queued':
+            job_store.release_job(job['id'])
+            logger.warning(f'Job queue full, leaving recovered job {job["id"]} for the next recovery pass')
+
+def next_job():
+    global queued_total
+    with lanes_cond:
+        while not ready:
+            lanes_cond.wait()
+        key = ready.popleft()
+        job = lanes[key].popleft()
+        queued_total -= 1
+        running.add(key)
+        return job
+
+def lane_done(key):
+    with lanes_cond:
+        running.discard(key)
+        if lanes.get(key):
+            ready.append(key)
+            lanes_cond.notify()
+        else:
+            lanes.pop(key, None)
+
+def requeue(job):
+    global queued_total
+    with lanes_cond:
+        lanes.setdefault(job['lane'], deque()).appendleft(job)
+        queued_total += 1
+    threading.Timer(DEFER_DELAY, lane_done, args=(job['lane'],)).start()
+
+def waiting(chat_id):
+    with lanes_cond:
+        return len(lanes.get(chat_id, ()))
+
+def idle():
+    with lanes_cond:
+        return not queued_total and not running
+
+def format_timings(timings):
+    return ' '.join(f'{name}={seconds:.2f}s' for name, seconds in timings.items())
+
+def worker_loop(handler):
+    while True:
+        job = next_job()
+        job['timings']['queued'] = time.time() - job['enqueued_at']
+        local.job = job
+        start = time.time()
+        outcome = 'ok'
+        try:
+            job_store.start_job(job['db_id'])
+            handler(job['payload'])
+        except Deferred:
+            metrics.inc('jobs_total', outcome='deferred')
+            job_store.defer_job(job['db_id'])
+            requeue(job)
+            continue
+        except Exception as e:
+            outcome = 'error'
+            logger.error(f'Job {job["id"]} error: {e}')
+        finally:
+            local.job = None
+        metrics.inc('jobs_total', outcome=outcome)
+        metrics.observe('job_seconds', time.time() - start)
+        
+        try:
+            job_store.finish_job(job['db_id'])
+        except Exception as e:
+            logger.error(f'Job {job["id"]} finish error: {e}')
+        lane_done(job['lane'])
+        encodes = f' encode={",".join(job["encode_speeds"])}' if job.get('encode_speeds') else ''
+        logger.info(f'Job {job["id"]} finished in {time.time() - start:.2f}s ({format_timings(job["timings"])}){encodes}')
+        if job.get('trace'):
+            logger.info(f'Job {job["id"]} trace: {" ".join(job["trace"])}')
+
+def start_workers(handler, concurrency=WORKER_CONCURRENCY):
+    with workers_lock:
+        if workers:
+            return
+        for i in range(concurrency):
+            worker = threading.Thread(target=worker_loop, args=(handler,), name=f'job-worker-{i}', daemon=True)
+            worker.start()
+            workers.append(worker)
+
+def collect_metrics():
+    with lanes_cond:
+        return [
+            ('job_queue_depth', 'gauge', 'Jobs waiting in the queue', [({}, queued_total)]),
+            ('job_lanes_running', 'gauge', 'Chat lanes with a job running', [({}, len(running))]),
+            ('job_lanes_ready', 'gauge', 'Chat lanes waiting for a worker', [({}, len(ready))])
+        ]
+
+metrics.register_collector(collect_metrics)
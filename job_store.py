@@ -0,0 +1,214 @@
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+import threading
+from config import JOB_DB_PATH, CHAT_LOCK_LEASE, JOB_MAX_ATTEMPTS
+
+logger = logging.getLogger(__name__)
+
+# Restarted containers often come back with the same hostname and PID, so
+# the owner carries a per-process nonce to tell a restart from the original.
+OWNER = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:12]}'
+
+local = threading.local()
+schema_lock = threading.Lock()
+schema_ready = False
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS chat_locks (chat_id INTEGER PRIMARY KEY, owner TEXT, lease_until REAL)',
+    'CREATE TABLE IF NOT EXISTS audio (video_id TEXT PRIMARY KEY, path TEXT, chat_id INTEGER, expires_at REAL)',
+    'CREATE INDEX IF NOT EXISTS audio_chat ON audio (chat_id)',
+    '''CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER, payload TEXT, state TEXT, stage TEXT,
+        owner TEXT, attempts INTEGER DEFAULT 0, files TEXT DEFAULT '[]', updated_at REAL
+    )'''
+]
+
+def get_db():
+    global schema_ready
+    conn = getattr(local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(JOB_DB_PATH, timeout=10, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        local.conn = conn
+    if not schema_ready:
+        with schema_lock:
+            if not schema_ready:
+                for statement in SCHEMA:
+                    conn.execute(statement)
+                schema_ready = True
+    return conn
+
+def owner_alive(owner):
+    if owner == OWNER:
+        return True
+    host, _, rest = (owner or '').partition(':')
+    pid = rest.split(':', 1)[0]
+    if host != socket.gethostname() or not pid.isdigit():
+        return None
+    if int(pid) == os.getpid():
+        return False
+    try:
+        os.kill(int(pid), 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+def acquire_chat(chat_id):
+    now = time.time()
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        row = conn.execute('SELECT owner, lease_until FROM chat_locks WHERE chat_id = ?', (chat_id,)).fetchone()
+        if row and row[1] > now and owner_alive(row[0]) is not False:
+            conn.execute('ROLLBACK')
+            return False
+        conn.execute('INSERT OR REPLACE INTO chat_locks (chat_id, owner, lease_until) VALUES (?, ?, ?)',
+                     (chat_id, OWNER, now + CHAT_LOCK_LEASE))
+        conn.execute('COMMIT')
+        return True
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+def release_chat(chat_id):
+    get_db().execute('DELETE FROM chat_locks WHERE chat_id = ? AND owner = ?', (chat_id, OWNER))
+
+def register_audio(video_id, path, chat_id, ttl):
+    get_db().execute('INSERT OR REPLACE INTO audio (video_id, path, chat_id, expires_at) VALUES (?, ?, ?, ?)',
+                     (video_id, path, chat_id, time.time() + ttl))
+
+def get_audio(video_id):
+    row = get_db().execute('SELECT path, chat_id FROM audio WHERE video_id = ?', (video_id,)).fetchone()
+    return (row[0], row[1]) if row else None
+
+def pop_audio(video_id, path=None):
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    row = conn.execute('SELECT path, chat_id FROM audio WHERE video_id = ?', (video_id,)).fetchone()
+    if not row or (path and row[0] != path):
+        conn.execute('ROLLBACK')
+        return None
+    conn.execute('DELETE FROM audio WHERE video_id = ?', (video_id,))
+    conn.execute('COMMIT')
+    return (row[0], row[1])
+
+def pop_expired_audio(video_id, path, now=None):
+    cursor = get_db().execute('DELETE FROM audio WHERE video_id = ? AND path = ? AND expires_at <= ?',
+                              (video_id, path, now or time.time()))
+    return cursor.rowcount > 0
+
+def extend_audio(video_id, ttl):
+    get_db().execute('UPDATE audio SET expires_at = MAX(expires_at, ?) WHERE video_id = ?', (time.time() + ttl, video_id))
+
+def audio_paths():
+    return get_db().execute('SELECT video_id, path, expires_at FROM audio').fetchall()
+
+def active_files():
+    paths = set()
+    for (files,) in get_db().execute("SELECT files FROM jobs WHERE state IN ('queued', 'running')"):
+        paths.update(json.loads(files or '[]'))
+    return paths
+
+def chat_audio(chat_id):
+    return get_db().execute('SELECT video_id, path FROM audio WHERE chat_id = ?', (chat_id,)).fetchall()
+
+def expired_audio(now=None):
+    return get_db().execute('SELECT video_id, path FROM audio WHERE expires_at <= ?', (now or time.time(),)).fetchall()
+
+def create_job(payload, chat_id):
+    cursor = get_db().execute(
+        'INSERT INTO jobs (chat_id, payload, state, stage, owner, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+        (chat_id, json.dumps(payload), 'queued', 'queued', OWNER, time.time())
+    )
+    return cursor.lastrowid
+
+def start_job(job_id):
+    get_db().execute("UPDATE jobs SET state = 'running', stage = 'started', owner = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                     (OWNER, time.time(), job_id))
+
+def defer_job(job_id):
+    get_db().execute("UPDATE jobs SET state = 'queued', stage = 'deferred', attempts = attempts - 1, updated_at = ? WHERE id = ?",
+                     (time.time(), job_id))
+
+def heartbeat(job_id, chat_id, stage):
+    now = time.time()
+    conn = get_db()
+    conn.execute('UPDATE jobs SET stage = ?, updated_at = ? WHERE id = ?', (stage, now, job_id))
+    if chat_id is not None:
+        conn.execute('UPDATE chat_locks SET lease_until = ? WHERE chat_id = ? AND owner = ?', (now + CHAT_LOCK_LEASE, chat_id, OWNER))
+
+def track_files(job_id, paths):
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    row = conn.execute('SELECT files FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    if row:
+        files = json.loads(row[0] or '[]')
+        files.extend(path for path in paths if path not in files)
+        conn.execute('UPDATE jobs SET files = ? WHERE id = ?', (json.dumps(files), job_id))
+    conn.execute('COMMIT')
+
+def release_job(job_id):
+    # Hand a claimed job back so the next recovery pass can pick it up.
+    get_db().execute("UPDATE jobs SET owner = '', updated_at = 0 WHERE id = ? AND owner = ?", (job_id, OWNER))
+
+def finish_job(job_id):
+    get_db().execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+def remove_files(paths, keep=()):
+    for path in paths:
+        if path in keep or not os.path.exists(path):
+            continue
+        try:
+            os.remove(path)
+            logger.info(f'Removed orphaned file: {path}')
+        except OSError as e:
+            logger.error(f'Orphan cleanup error: {e}')
+
+def stale(owner, updated_at, now):
+    alive = owner_alive(owner)
+    if alive is None:
+        return updated_at + CHAT_LOCK_LEASE < now
+    return not alive
+
+def recover():
+    now = time.time()
+    conn = get_db()
+    resumed = []
+    failed = []
+    kept = {row[0] for row in conn.execute('SELECT path FROM audio')}
+    
+    for chat_id, owner, lease_until in conn.execute('SELECT chat_id, owner, lease_until FROM chat_locks').fetchall():
+        if lease_until <= now or stale(owner, now, now):
+            conn.execute('DELETE FROM chat_locks WHERE chat_id = ? AND owner = ?', (chat_id, owner))
+    
+    rows = conn.execute("SELECT id, chat_id, payload, owner, attempts, files, updated_at FROM jobs WHERE state IN ('queued', 'running')").fetchall()
+    for job_id, chat_id, payload, owner, attempts, files, updated_at in rows:
+        if owner == OWNER or not stale(owner, updated_at, now):
+            continue
+        claimed = conn.execute("UPDATE jobs SET owner = ?, state = 'queued', files = '[]', updated_at = ? WHERE id = ? AND owner = ?",
+                               (OWNER, now, job_id, owner)).rowcount
+        if not claimed:
+            continue
+        remove_files(json.loads(files or '[]'), keep=kept)
+        job = {'id': job_id, 'chat_id': chat_id, 'payload': json.loads(payload)}
+        if attempts < JOB_MAX_ATTEMPTS:
+            resumed.append(job)
+        else:
+            finish_job(job_id)
+            failed.append(job)
+    
+    for video_id, path in expired_audio(now):
+        if pop_audio(video_id, path):
+            remove_files([path])
+    
+    if resumed or failed:
+        logger.info(f'Recovered {len(resumed)} interrupted job(s), gave up on {len(failed)}')
+    return resumed, failed
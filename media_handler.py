@@ -1,63 +1,314 @@
+import io
 import os
+import json
+import time
+import struct
 import logging
 import subprocess
-from config import MAX_FILE_SIZE_MB, TEMP_DIR, COMPRESSION_QUALITY
+import metrics
+from config import MAX_FILE_SIZE_MB, TEMP_DIR, COMPRESSION_QUALITY, MAX_PHOTO_SIZE_MB, MAX_PHOTO_DIMENSIONS
+from transcode_scheduler import transcode_slot
 
 logger = logging.getLogger(__name__)
 
+PHOTO_FORMATS = ('JPEG', 'PNG', 'WEBP')
+IMAGE_QUALITY_RANGE = (40, 90)
+IMAGE_QUALITY_STEPS = 6
+IMAGE_RESIZE_ATTEMPTS = 2
+
 def get_file_size_mb(file_path):
     if os.path.exists(file_path):
         return os.path.getsize(file_path) / (1024 * 1024)
     return 0
 
-def compress_video(input_path, output_path, crf=23):
+def moov_before_mdat(file_path):
+    try:
+        with open(file_path, 'rb') as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return False
+                size, kind = struct.unpack('>I4s', header)
+                if kind == b'moov':
+                    return True
+                if kind == b'mdat':
+                    return False
+                if size == 1:
+                    size = struct.unpack('>Q', f.read(8))[0]
+                    f.seek(size - 16, 1)
+                elif size >= 8:
+                    f.seek(size - 8, 1)
+                else:
+                    return False
+    except (OSError, struct.error):
+        return False
+
+def probe_media(file_path):
+    try:
+        cmd = [
+            'ffprobe', '-v', 'error', '-print_format', 'json',
+            '-show_format', '-show_streams', file_path
+        ]
+        output = subprocess.run(cmd, capture_output=True, check=True, timeout=30).stdout
+        info = json.loads(output)
+    except Exception as e:
+        logger.error(f'Probe error: {e}')
+        return None
+    
+    streams = info.get('streams', [])
+    fmt = info.get('format', {})
+    video = next((s for s in streams if s.get('codec_type') == 'video'), None)
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+    
+    return {
+        'video_codec': video.get('codec_name') if video else None,
+        'audio_codec': audio.get('codec_name') if audio else None,
+        'pix_fmt': video.get('pix_fmt') if video else None,
+        'width': video.get('width', 0) if video else 0,
+        'height': video.get('height', 0) if video else 0,
+        'duration': float(fmt.get('duration') or 0),
+        'bitrate': int(fmt.get('bit_rate') or 0),
+        'format_name': fmt.get('format_name', ''),
+        'faststart': moov_before_mdat(file_path)
+    }
+
+def is_telegram_compatible(probe):
+    return (
+        probe['video_codec'] == 'h264'
+        and probe['pix_fmt'] in ('yuv420p', 'yuvj420p', None)
+        and probe['audio_codec'] in ('aac', None)
+        and 'mp4' in probe['format_name']
+    )
+
+def target_video_bitrate_k(duration, audio_bitrate_k=128):
+    if duration <= 0:
+        return None
+    budget_k = MAX_FILE_SIZE_MB * 8 * 1024 * 1024 * 0.92 / duration / 1000
+    return max(int(budget_k - audio_bitrate_k), 100)
+
+def remux_video(input_path, output_path):
     try:
         cmd = [
             'ffmpeg', '-i', input_path,
-            '-c:v', 'libx264', '-crf', str(crf),
-            '-preset', 'medium', '-c:a', 'aac',
-            '-b:a', '128k', '-movflags', '+faststart',
+            '-c', 'copy', '-movflags', '+faststart',
             '-y', output_path
         ]
-        subprocess.run(cmd, capture_output=True, check=True, timeout=180)
+        subprocess.run(cmd, capture_output=True, check=True, timeout=60)
         if os.path.exists(output_path):
             return output_path
     except Exception as e:
-        logger.error(f'Compression error: {e}')
+        logger.error(f'Remux error: {e}')
     return None
 
-def compress_image(input_path, output_path, quality=85):
+def run_ffmpeg(cmd, timeout, duration=0, progress=None):
+    if not progress or duration <= 0:
+        subprocess.run(cmd, capture_output=True, check=True, timeout=timeout)
+        return
+    
+    cmd = cmd[:1] + ['-progress', 'pipe:1', '-nostats'] + cmd[1:]
+    deadline = time.time() + timeout
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
     try:
-        from PIL import Image
-        img = Image.open(input_path)
-        if img.mode in ('RGBA', 'LA', 'P'):
-            img = img.convert('RGB')
-        img.save(output_path, 'JPEG', quality=quality, optimize=True)
+        for line in process.stdout:
+            if time.time() > deadline:
+                raise subprocess.TimeoutExpired(cmd, timeout)
+            key, _, value = line.strip().partition('=')
+            if key == 'out_time_us' and value.isdigit():
+                progress(min(1.0, int(value) / 1000000 / duration))
+        process.wait(timeout=max(1, deadline - time.time()))
+    except Exception:
+        process.kill()
+        process.wait()
+        raise
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+
+def compress_video(input_path, output_path, crf=23, max_bitrate_k=None, duration=0, progress=None):
+    try:
+        with transcode_slot(duration) as encode:
+            cmd = [
+                'ffmpeg', '-i', input_path,
+                '-c:v', 'libx264', '-crf', str(crf),
+                '-preset', encode['preset'], '-threads', str(encode['threads'])
+            ]
+            if max_bitrate_k:
+                cmd += ['-maxrate', f'{max_bitrate_k}k', '-bufsize', f'{max_bitrate_k * 2}k']
+            cmd += [
+                '-pix_fmt', 'yuv420p', '-c:a', 'aac',
+                '-b:a', '128k', '-movflags', '+faststart',
+                '-y', output_path
+            ]
+            run_ffmpeg(cmd, encode['timeout'], duration, progress)
         if os.path.exists(output_path):
             return output_path
+    except Exception as e:
+        logger.error(f'Compression error: {e}')
+    return None
+
+def image_within_limits(file_path, file_size):
+    if file_size > MAX_PHOTO_SIZE_MB:
+        return False
+    try:
+        from PIL import Image
+        with Image.open(file_path) as img:
+            width, height = img.size
+            return img.format in PHOTO_FORMATS and width + height <= MAX_PHOTO_DIMENSIONS
+    except Exception as e:
+        logger.error(f'Image probe error: {e}')
+        return False
+
+def load_image(input_path):
+    from PIL import Image, ImageOps
+    img = Image.open(input_path)
+    width, height = img.size
+    scale = min(1.0, MAX_PHOTO_DIMENSIONS / (width + height))
+    target = (max(1, int(width * scale)), max(1, int(height * scale)))
+    if scale < 1:
+        # JPEG draft mode decodes at 1/2, 1/4 or 1/8 scale straight from the
+        # DCT coefficients, so huge photos never get fully decoded.
+        img.draft('RGB', target)
+    img = ImageOps.exif_transpose(img)
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    if img.width + img.height > MAX_PHOTO_DIMENSIONS:
+        scale = MAX_PHOTO_DIMENSIONS / (img.width + img.height)
+        size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+        img = img.resize(size, Image.LANCZOS, reducing_gap=2.0)
+    return img
+
+def encode_jpeg(img, quality):
+    buffer = io.BytesIO()
+    img.save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+def compress_image(input_path, output_path, max_size_mb=MAX_PHOTO_SIZE_MB):
+    try:
+        from PIL import Image
+        img = load_image(input_path)
+        limit = max_size_mb * 1024 * 1024
+        best = None
+        
+        for _ in range(IMAGE_RESIZE_ATTEMPTS):
+            low, high = IMAGE_QUALITY_RANGE
+            smallest = None
+            for _ in range(IMAGE_QUALITY_STEPS):
+                if low > high:
+                    break
+                quality = (low + high) // 2
+                data = encode_jpeg(img, quality)
+                if len(data) <= limit:
+                    best = data
+                    low = quality + 1
+                else:
+                    smallest = len(data)
+                    high = quality - 1
+            if best:
+                break
+            shrink = (limit / smallest) ** 0.5 * 0.9
+            img = img.resize((max(1, int(img.width * shrink)), max(1, int(img.height * shrink))), Image.LANCZOS)
+        
+        if not best:
+            return None
+        with open(output_path, 'wb') as f:
+            f.write(best)
+        return output_path
     except Exception as e:
         logger.error(f'Image compression error: {e}')
     return None
 
-def extract_audio(video_path, audio_path):
+def copy_audio_stream(video_path, audio_path):
     try:
         cmd = [
             'ffmpeg', '-i', video_path,
-            '-vn', '-acodec', 'libmp3lame',
-            '-q:a', '2', '-y', audio_path
+            '-vn', '-c:a', 'copy', '-movflags', '+faststart',
+            '-y', audio_path
         ]
-        subprocess.run(cmd, capture_output=True, check=True, timeout=120)
-        if os.path.exists(audio_path):
+        subprocess.run(cmd, capture_output=True, check=True, timeout=60)
+        if os.path.exists(audio_path) and os.path.getsize(audio_path) > 0:
+            return audio_path
+    except Exception as e:
+        logger.info(f'Audio stream copy failed, re-encoding: {e}')
+    if os.path.exists(audio_path):
+        os.remove(audio_path)
+    return None
+
+def extract_audio(video_path, audio_path):
+    if audio_path.endswith('.m4a'):
+        with metrics.timed('audio_extract_seconds', method='copy') as labels:
+            result = copy_audio_stream(video_path, audio_path)
+            labels['outcome'] = 'ok' if result else 'error'
+        if result:
+            return result
+        audio_path = os.path.splitext(audio_path)[0] + '.mp3'
+    
+    with metrics.timed('audio_extract_seconds', method='mp3', outcome='error') as labels:
+        try:
+            cmd = [
+                'ffmpeg', '-i', video_path,
+                '-vn', '-acodec', 'libmp3lame',
+                '-q:a', '2', '-y', audio_path
+            ]
+            subprocess.run(cmd, capture_output=True, check=True, timeout=120)
+            if os.path.exists(audio_path):
+                labels['outcome'] = 'ok'
+                return audio_path
+        except Exception as e:
+            logger.error(f'Audio extraction error: {e}')
+    return None
+
+def extract_audio_from_stream(open_chunks, audio_path):
+    with metrics.timed('audio_extract_seconds', method='stream') as labels:
+        result = pipe_audio(open_chunks, audio_path)
+        labels['outcome'] = 'ok' if result else 'error'
+    return result
+
+def pipe_audio(open_chunks, audio_path):
+    if audio_path.endswith('.m4a'):
+        codec_args = ['-c:a', 'copy', '-movflags', '+faststart']
+    else:
+        codec_args = ['-acodec', 'libmp3lame', '-q:a', '2']
+    cmd = ['ffmpeg', '-i', 'pipe:0', '-vn'] + codec_args + ['-y', audio_path]
+    
+    process = None
+    try:
+        process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            for chunk in open_chunks():
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            pass
+        finally:
+            process.stdin.close()
+        process.wait(timeout=120)
+        if process.returncode == 0 and os.path.exists(audio_path) and os.path.getsize(audio_path) > 0:
             return audio_path
     except Exception as e:
-        logger.error(f'Audio extraction error: {e}')
+        logger.info(f'Piped audio extraction failed: {e}')
+        if process and process.poll() is None:
+            process.kill()
+    
+    if os.path.exists(audio_path):
+        os.remove(audio_path)
     return None
 
-def optimize_media(file_path, media_type='video'):
+def record_compression(crf, input_size, output_size):
+    if input_size > 0:
+        metrics.observe('compression_ratio', output_size / input_size, crf=crf)
+
+def optimize_media(file_path, media_type='video', progress=None):
     file_size = get_file_size_mb(file_path)
     
     if media_type == 'video':
-        compressed_path = file_path.replace('.mp4', '_compressed.mp4')
+        compressed_path = os.path.splitext(file_path)[0] + '_compressed.mp4'
+        probe = probe_media(file_path)
+        
+        if probe and file_size <= MAX_FILE_SIZE_MB and is_telegram_compatible(probe):
+            if probe['faststart']:
+                return file_path, file_size
+            result = remux_video(file_path, compressed_path)
+            if result:
+                os.remove(file_path)
+                return result, get_file_size_mb(result)
         
         if file_size > MAX_FILE_SIZE_MB:
             crf = 28
@@ -66,18 +317,24 @@ def optimize_media(file_path, media_type='video'):
         else:
             crf = COMPRESSION_QUALITY
         
-        result = compress_video(file_path, compressed_path, crf)
+        duration = probe['duration'] if probe else 0
+        max_bitrate_k = target_video_bitrate_k(duration) if probe else None
+        result = compress_video(file_path, compressed_path, crf, max_bitrate_k, duration, progress)
         
         if result:
             new_size = get_file_size_mb(result)
+            record_compression(crf, file_size, new_size)
             if new_size <= MAX_FILE_SIZE_MB:
                 os.remove(file_path)
                 return result, new_size
             elif new_size > MAX_FILE_SIZE_MB and crf < 32:
                 os.remove(result)
-                result = compress_video(file_path, compressed_path, 32)
+                if max_bitrate_k:
+                    max_bitrate_k = int(max_bitrate_k * MAX_FILE_SIZE_MB / new_size * 0.9)
+                result = compress_video(file_path, compressed_path, 32, max_bitrate_k, duration, progress)
                 if result:
                     final_size = get_file_size_mb(result)
+                    record_compression(32, file_size, final_size)
                     if final_size <= MAX_FILE_SIZE_MB:
                         os.remove(file_path)
                         return result, final_size
@@ -86,18 +343,14 @@ def optimize_media(file_path, media_type='video'):
         return None, file_size
     
     elif media_type == 'photo':
-        if file_size <= MAX_FILE_SIZE_MB:
+        if image_within_limits(file_path, file_size):
             return file_path, file_size
         
-        compressed_path = file_path.replace('.jpg', '_compressed.jpg')
-        quality = 85 if file_size < 10 else 75
-        
-        result = compress_image(file_path, compressed_path, quality)
+        compressed_path = os.path.splitext(file_path)[0] + '_compressed.jpg'
+        result = compress_image(file_path, compressed_path)
         if result:
-            new_size = get_file_size_mb(result)
-            if new_size <= MAX_FILE_SIZE_MB:
-                os.remove(file_path)
-                return result, new_size
+            os.remove(file_path)
+            return result, get_file_size_mb(result)
         
         return None, file_size
     
@@ -0,0 +1,120 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from config import METRICS_TRACE
+
+logger = logging.getLogger(__name__)
+
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.25, 1.5, 2.0)
+
+METRICS = {
+    'job_seconds': ('histogram', 'Wall time of a job from start to finish', SECONDS_BUCKETS),
+    'job_stage_seconds': ('histogram', 'Time spent in each job stage', SECONDS_BUCKETS),
+    'jobs_total': ('counter', 'Jobs processed by outcome', None),
+    'download_seconds': ('histogram', 'Instagram download time by source and outcome', SECONDS_BUCKETS),
+    'download_source_total': ('counter', 'Which download path delivered the media', None),
+    'download_bytes_total': ('counter', 'Bytes downloaded from Instagram', None),
+    'optimize_seconds': ('histogram', 'Media optimization time by kind', SECONDS_BUCKETS),
+    'optimize_bytes_in_total': ('counter', 'Bytes handed to media optimization', None),
+    'optimize_bytes_out_total': ('counter', 'Bytes produced by media optimization', None),
+    'compression_ratio': ('histogram', 'Output/input size of each video encode by CRF', RATIO_BUCKETS),
+    'transcode_seconds': ('histogram', 'ffmpeg video encode time by preset', SECONDS_BUCKETS),
+    'transcode_wait_seconds': ('histogram', 'Time spent waiting for a transcode slot', SECONDS_BUCKETS),
+    'transcode_media_seconds_total': ('counter', 'Seconds of video encoded by preset', None),
+    'audio_extract_seconds': ('histogram', 'Audio extraction time by method and outcome', SECONDS_BUCKETS),
+    'telegram_request_seconds': ('histogram', 'Bot API request latency by method and outcome', SECONDS_BUCKETS),
+    'telegram_upload_bytes_total': ('counter', 'Bytes uploaded to the Bot API by method', None),
+    'telegram_send_wait_seconds': ('histogram', 'Time sends waited on the rate limiter by lane', SECONDS_BUCKETS)
+}
+
+registry_lock = threading.Lock()
+values = {}
+collectors = []
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def inc(name, value=1, **labels):
+    key = (name, label_key(labels))
+    with registry_lock:
+        values[key] = values.get(key, 0) + value
+
+def observe(name, value, **labels):
+    buckets = METRICS[name][2]
+    key = (name, label_key(labels))
+    with registry_lock:
+        histogram = values.get(key)
+        if histogram is None:
+            histogram = values[key] = {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+def trace(name, seconds, labels):
+    from job_queue import current_job
+    job = current_job()
+    if job is not None:
+        detail = ','.join(f'{key}={value}' for key, value in label_key(labels))
+        job.setdefault('trace', []).append(f'{name}[{detail}]={seconds:.2f}s' if detail else f'{name}={seconds:.2f}s')
+
+def timing(name, seconds, **labels):
+    observe(name, seconds, **labels)
+    if METRICS_TRACE:
+        trace(name, seconds, labels)
+
+@contextmanager
+def timed(name, **labels):
+    start = time.time()
+    try:
+        yield labels
+    finally:
+        timing(name, time.time() - start, **labels)
+
+def register_collector(fn):
+    collectors.append(fn)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render():
+    with registry_lock:
+        snapshot = {key: dict(value, buckets=list(value['buckets'])) if isinstance(value, dict) else value
+                    for key, value in values.items()}
+
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        series = sorted(((labels, value) for (metric, labels), value in snapshot.items() if metric == name), key=lambda item: item[0])
+        if not series:
+            continue
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        for labels, value in series:
+            if kind != 'histogram':
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+                continue
+            for bound, count in zip(buckets, value['buckets']):
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {count}')
+            lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {value["count"]}')
+            lines.append(f'{name}_sum{format_labels(labels)} {format_value(value["sum"])}')
+            lines.append(f'{name}_count{format_labels(labels)} {value["count"]}')
+
+    for collect in collectors:
+        try:
+            samples = collect()
+        except Exception as e:
+            logger.error(f'Metrics collector error: {e}')
+            continue
+        for name, kind, help_text, series in samples:
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+            for labels, value in series:
+                lines.append(f'{name}{format_labels(label_key(labels))} {format_value(value)}')
+    return '\n'.join(lines) + '\n'
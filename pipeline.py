@@ -0,0 +1,92 @@
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from config import MEDIA_PROCESS_WORKERS, IO_THREADS, BATCH_FETCH_CONCURRENCY, CALLBACK_THREADS
+import metrics
+from media_handler import optimize_media
+from job_queue import bind
+
+logger = logging.getLogger(__name__)
+
+pools_lock = threading.Lock()
+process_pool = None
+encode_pool = None
+io_pool = None
+fetch_pool = None
+callback_pool = None
+
+def init_worker():
+    logging.basicConfig(level=logging.INFO)
+
+def get_process_pool():
+    global process_pool
+    with pools_lock:
+        if process_pool is None:
+            process_pool = ProcessPoolExecutor(
+                max_workers=MEDIA_PROCESS_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_worker
+            )
+        return process_pool
+
+def get_encode_pool():
+    global encode_pool
+    with pools_lock:
+        if encode_pool is None:
+            encode_pool = ThreadPoolExecutor(max_workers=MEDIA_PROCESS_WORKERS, thread_name_prefix='media-encode')
+        return encode_pool
+
+def get_io_pool():
+    global io_pool
+    with pools_lock:
+        if io_pool is None:
+            io_pool = ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix='media-io')
+        return io_pool
+
+def get_fetch_pool():
+    global fetch_pool
+    with pools_lock:
+        if fetch_pool is None:
+            fetch_pool = ThreadPoolExecutor(max_workers=BATCH_FETCH_CONCURRENCY, thread_name_prefix='media-fetch')
+        return fetch_pool
+
+def get_callback_pool():
+    global callback_pool
+    with pools_lock:
+        if callback_pool is None:
+            callback_pool = ThreadPoolExecutor(max_workers=CALLBACK_THREADS, thread_name_prefix='callback')
+        return callback_pool
+
+def record_optimize(media_type, input_size, start):
+    # Photos are optimized in the process pool, where metrics would be lost,
+    # so the numbers are taken here in the parent once the future resolves.
+    def done(future):
+        metrics.observe('optimize_seconds', time.time() - start, kind=media_type)
+        if future.cancelled() or future.exception():
+            return
+        path, size_mb = future.result()
+        metrics.inc('optimize_bytes_in_total', input_size, kind=media_type)
+        if path:
+            metrics.inc('optimize_bytes_out_total', int(size_mb * 1024 * 1024), kind=media_type)
+    return done
+
+def optimize_async(file_path, media_type, progress=None):
+    input_size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+    if media_type == 'video':
+        future = get_encode_pool().submit(bind(optimize_media), file_path, media_type, progress)
+    else:
+        future = get_process_pool().submit(optimize_media, file_path, media_type)
+    future.add_done_callback(record_optimize(media_type, input_size, time.time()))
+    return future
+
+def io_async(fn, *args):
+    return get_io_pool().submit(bind(fn), *args)
+
+def fetch_async(fn, *args):
+    return get_fetch_pool().submit(bind(fn), *args)
+
+def callback_async(fn, *args):
+    return get_callback_pool().submit(fn, *args)
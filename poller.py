@@ -0,0 +1,107 @@
+import os
+import signal
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import job_queue
+import handlers
+from telegram_sender import get_updates, delete_webhook
+from config import BOT_MODE, POLL_TIMEOUT, POLLER_CONCURRENCY, POLLER_OFFSET_PATH, POLLER_DRAIN_TIMEOUT
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+FULL_RETRY_DELAY = 1
+ERROR_RETRY_DELAY = 5
+
+def load_offset():
+    try:
+        with open(POLLER_OFFSET_PATH) as f:
+            return int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+def save_offset(offset):
+    try:
+        os.makedirs(os.path.dirname(POLLER_OFFSET_PATH), exist_ok=True)
+        tmp_path = f'{POLLER_OFFSET_PATH}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(offset))
+        os.replace(tmp_path, POLLER_OFFSET_PATH)
+    except OSError as e:
+        logger.error(f'Offset save error: {e}')
+
+def accept(update):
+    # The job row is written by accept_update, so the offset moves past the
+    # update right after it; a crash between updates then neither drops nor
+    # re-delivers anything already stored.
+    status = handlers.accept_update(update)
+    if status != 'full':
+        save_offset(update['update_id'] + 1)
+    return status
+
+async def submit(loop, executor, update, stopping):
+    # A full queue is backpressure, not a reason to drop the update: hold
+    # the offset here until the queue has room, Telegram keeps the rest.
+    while True:
+        status = await loop.run_in_executor(executor, accept, update)
+        if status != 'full' or stopping.is_set():
+            return status != 'full'
+        await asyncio.sleep(FULL_RETRY_DELAY)
+
+async def poll(stopping):
+    loop = asyncio.get_running_loop()
+    # The long poll, offset writes and job submission (SQLite) block, so they
+    # run off the loop; the handlers themselves run on the job workers.
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='poller')
+    offset = load_offset()
+    await loop.run_in_executor(executor, delete_webhook)
+    logger.info(f'Polling for updates from offset {offset}')
+
+    while not stopping.is_set():
+        fetch = loop.run_in_executor(executor, get_updates, offset, POLL_TIMEOUT)
+        stop_wait = asyncio.ensure_future(stopping.wait())
+        done, _ = await asyncio.wait([fetch, stop_wait], return_when=asyncio.FIRST_COMPLETED)
+        stop_wait.cancel()
+        if fetch not in done:
+            break
+
+        updates = fetch.result()
+        if updates is None:
+            await asyncio.sleep(ERROR_RETRY_DELAY)
+            continue
+
+        for update in updates:
+            if not await submit(loop, executor, update, stopping):
+                break
+            offset = update['update_id'] + 1
+
+    executor.shutdown(wait=False)
+
+async def drain():
+    deadline = asyncio.get_running_loop().time() + POLLER_DRAIN_TIMEOUT
+    while not job_queue.idle():
+        if asyncio.get_running_loop().time() > deadline:
+            logger.warning('Drain timed out, unfinished jobs will be recovered on restart')
+            return
+        await asyncio.sleep(0.5)
+
+async def run():
+    # Polling deletes the webhook, so running it next to the web process
+    # would silently starve that one; BOT_MODE picks exactly one of them.
+    if BOT_MODE != 'poll':
+        logger.error('BOT_MODE is not "poll", refusing to replace the webhook')
+        return
+    
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    handlers.start(POLLER_CONCURRENCY)
+    await poll(stopping)
+    logger.info('Stopped polling, draining jobs')
+    await drain()
+
+if __name__ == '__main__':
+    asyncio.run(run())
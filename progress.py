@@ -0,0 +1,78 @@
+import time
+import logging
+import threading
+from config import PROGRESS_UPDATE_INTERVAL
+from rate_limiter import STATUS
+from telegram_sender import send_message, edit_message_text, delete_message
+
+logger = logging.getLogger(__name__)
+
+class StatusMessage:
+    def __init__(self, chat_id, message_id=None):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = None
+        self.updated_at = 0
+        self.notes = []
+        self.lock = threading.Lock()
+    
+    def show(self, text):
+        if self.message_id:
+            edit_message_text(self.chat_id, self.message_id, text)
+            return
+        response = send_message(self.chat_id, text, priority=STATUS)
+        if response and response.get('ok'):
+            self.message_id = response['result']['message_id']
+    
+    def update(self, text, force=False):
+        if force:
+            self.lock.acquire()
+        elif not self.lock.acquire(blocking=False):
+            return
+        try:
+            now = time.time()
+            if text == self.text or (not force and now - self.updated_at < PROGRESS_UPDATE_INTERVAL):
+                return
+            self.text = text
+            self.updated_at = now
+            self.show(text)
+        finally:
+            self.lock.release()
+    
+    def note(self, text):
+        with self.lock:
+            self.notes.append(text)
+    
+    def finish(self, text=None):
+        with self.lock:
+            lines = ([text] if text else []) + self.notes
+            if lines:
+                self.show('\n'.join(lines))
+            elif self.message_id:
+                delete_message(self.chat_id, self.message_id)
+                self.message_id = None
+
+def format_mb(num_bytes):
+    return f'{num_bytes / (1024 * 1024):.1f}'
+
+def download_progress(status):
+    def report(done_bytes, total_bytes=None):
+        if total_bytes:
+            percent = min(100, int(done_bytes * 100 / total_bytes))
+            status.update(f'Downloading from Instagram... {format_mb(done_bytes)}/{format_mb(total_bytes)} MB ({percent}%)')
+        else:
+            status.update(f'Downloading from Instagram... {format_mb(done_bytes)} MB')
+    return report
+
+def processing_progress(status, total):
+    fractions = {}
+    lock = threading.Lock()
+    
+    def for_item(idx):
+        def report(fraction):
+            with lock:
+                fractions[idx] = fraction
+                percent = int(sum(fractions.values()) * 100 / total)
+            status.update(f'Processing {total} file(s)... {percent}%')
+        return report
+    return for_item
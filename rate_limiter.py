@@ -0,0 +1,143 @@
+import time
+import logging
+import itertools
+import threading
+import metrics
+from config import TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_GROUP_RATE
+
+logger = logging.getLogger(__name__)
+
+MEDIA, MESSAGE, STATUS = 0, 1, 2
+LANES = {MEDIA: 'media', MESSAGE: 'message', STATUS: 'status'}
+METHOD_PRIORITY = {
+    'sendVideo': MEDIA,
+    'sendPhoto': MEDIA,
+    'sendAudio': MEDIA,
+    'sendMediaGroup': MEDIA,
+    'sendMessage': MESSAGE,
+    'editMessageText': STATUS,
+    'deleteMessage': STATUS
+}
+CHAT_BUCKET_LIMIT = 1000
+SLOW_WAIT = 5
+
+waiters = []
+waiters_cond = threading.Condition()
+sequence = itertools.count()
+chat_buckets = {}
+stats = {name: {'waiting': 0, 'sent': 0, 'wait_total': 0.0, 'wait_max': 0.0} for name in LANES.values()}
+throttled = {'count': 0}
+
+def new_bucket(rate, burst):
+    return {'rate': rate, 'burst': burst, 'tokens': burst, 'refilled_at': time.time(), 'paused_until': 0}
+
+global_bucket = new_bucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+
+def refill(bucket, now):
+    bucket['tokens'] = min(bucket['burst'], bucket['tokens'] + (now - bucket['refilled_at']) * bucket['rate'])
+    bucket['refilled_at'] = now
+
+def ready_in(bucket, now, cost=1):
+    # A send costing more than the burst goes once the bucket is full and
+    # leaves it in debt, which later sends then wait out.
+    refill(bucket, now)
+    wait = bucket['paused_until'] - now
+    need = min(cost, bucket['burst'])
+    if bucket['tokens'] < need:
+        wait = max(wait, (need - bucket['tokens']) / bucket['rate'])
+    return max(wait, 0)
+
+def is_group(chat_id):
+    return str(chat_id).startswith('-')
+
+def chat_bucket(chat_id):
+    bucket = chat_buckets.get(chat_id)
+    if bucket is None:
+        if len(chat_buckets) >= CHAT_BUCKET_LIMIT:
+            prune_buckets()
+        if is_group(chat_id):
+            bucket = new_bucket(TELEGRAM_GROUP_RATE / 60, TELEGRAM_CHAT_BURST)
+        else:
+            bucket = new_bucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+        chat_buckets[chat_id] = bucket
+    return bucket
+
+def prune_buckets():
+    now = time.time()
+    waiting = {waiter[2] for waiter in waiters}
+    for chat_id, bucket in list(chat_buckets.items()):
+        refill(bucket, now)
+        if chat_id not in waiting and bucket['tokens'] >= bucket['burst'] and bucket['paused_until'] <= now:
+            del chat_buckets[chat_id]
+
+def next_delay(waiter, now):
+    # Waiters are ordered by (priority, arrival). The first one whose chat
+    # bucket has a token gets the next global token; waiters blocked on their
+    # own chat do not hold up other chats.
+    for other in waiters:
+        chat_wait = ready_in(chat_bucket(other[2]), now, other[3])
+        if other is waiter:
+            return max(chat_wait, ready_in(global_bucket, now, waiter[3]))
+        if chat_wait <= 0:
+            return max(ready_in(global_bucket, now, other[3]), 0.05)
+    return 0
+
+def acquire(chat_id, priority=MESSAGE, cost=1):
+    lane = stats[LANES[priority]]
+    waiter = (priority, next(sequence), chat_id, cost)
+    start = time.time()
+    with waiters_cond:
+        waiters.append(waiter)
+        waiters.sort()
+        lane['waiting'] += 1
+        try:
+            while True:
+                delay = next_delay(waiter, time.time())
+                if delay <= 0:
+                    break
+                waiters_cond.wait(delay)
+            chat_bucket(chat_id)['tokens'] -= cost
+            global_bucket['tokens'] -= cost
+        finally:
+            waiters.remove(waiter)
+            lane['waiting'] -= 1
+            waiters_cond.notify_all()
+
+        waited = time.time() - start
+        lane['sent'] += 1
+        lane['wait_total'] += waited
+        lane['wait_max'] = max(lane['wait_max'], waited)
+
+    metrics.timing('telegram_send_wait_seconds', waited, lane=LANES[priority])
+    if waited > SLOW_WAIT:
+        logger.warning(f'Send to chat {chat_id} waited {waited:.1f}s for rate limit ({LANES[priority]} lane)')
+    return waited
+
+def penalize(chat_id, retry_after):
+    with waiters_cond:
+        throttled['count'] += 1
+        bucket = chat_bucket(chat_id) if chat_id is not None else global_bucket
+        bucket['paused_until'] = max(bucket['paused_until'], time.time() + retry_after)
+        waiters_cond.notify_all()
+
+def limiter_stats():
+    with waiters_cond:
+        return {
+            'lanes': {
+                name: dict(lane, avg_wait=lane['wait_total'] / lane['sent'] if lane['sent'] else 0.0)
+                for name, lane in stats.items()
+            },
+            'queue_depth': len(waiters),
+            'throttled': throttled['count'],
+            'chats': len(chat_buckets)
+        }
+
+def collect_metrics():
+    with waiters_cond:
+        depth = [({'lane': name}, lane['waiting']) for name, lane in stats.items()]
+        return [
+            ('telegram_send_queue_depth', 'gauge', 'Sends waiting on the rate limiter by lane', depth),
+            ('telegram_throttled_total', 'counter', '429 responses from the Bot API', [({}, throttled['count'])])
+        ]
+
+metrics.register_collector(collect_metrics)
@@ -0,0 +1,110 @@
+import json
+import time
+import sqlite3
+import logging
+import threading
+import metrics
+from config import RESULT_CACHE_PATH, RESULT_CACHE_TTL, RESULT_CACHE_MAX_ENTRIES
+
+logger = logging.getLogger(__name__)
+
+db_lock = threading.Lock()
+db = None
+stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def get_db():
+    global db
+    if db is None:
+        db = sqlite3.connect(RESULT_CACHE_PATH, check_same_thread=False, timeout=10)
+        db.execute('CREATE TABLE IF NOT EXISTS results (shortcode TEXT PRIMARY KEY, caption TEXT, items TEXT, created_at REAL, last_used REAL)')
+        db.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+        db.execute('CREATE TABLE IF NOT EXISTS audio (video_id TEXT PRIMARY KEY, file_id TEXT, created_at REAL)')
+        db.execute('CREATE TABLE IF NOT EXISTS videos (video_id TEXT PRIMARY KEY, file_id TEXT, created_at REAL)')
+        db.commit()
+    return db
+
+def get(shortcode):
+    if not shortcode:
+        return None
+    now = time.time()
+    try:
+        with db_lock:
+            conn = get_db()
+            row = conn.execute('SELECT caption, items, created_at FROM results WHERE shortcode = ?', (shortcode,)).fetchone()
+            if not row or now - row[2] > RESULT_CACHE_TTL:
+                stats['misses'] += 1
+                return None
+            conn.execute('UPDATE results SET last_used = ? WHERE shortcode = ?', (now, shortcode))
+            conn.commit()
+        stats['hits'] += 1
+        return {'caption': row[0], 'items': json.loads(row[1])}
+    except Exception as e:
+        logger.error(f'Result cache read error: {e}')
+        return None
+
+def put(shortcode, caption, items):
+    if not shortcode or not items:
+        return
+    now = time.time()
+    try:
+        with db_lock:
+            conn = get_db()
+            conn.execute(
+                'INSERT OR REPLACE INTO results (shortcode, caption, items, created_at, last_used) VALUES (?, ?, ?, ?, ?)',
+                (shortcode, caption, json.dumps(items), now, now)
+            )
+            evict(conn, now)
+            conn.commit()
+    except Exception as e:
+        logger.error(f'Result cache write error: {e}')
+
+def evict(conn, now):
+    expired = conn.execute('DELETE FROM results WHERE created_at < ?', (now - RESULT_CACHE_TTL,)).rowcount
+    conn.execute('DELETE FROM audio WHERE created_at < ?', (now - RESULT_CACHE_TTL,))
+    conn.execute('DELETE FROM videos WHERE created_at < ?', (now - RESULT_CACHE_TTL,))
+    overflow = conn.execute(
+        'DELETE FROM results WHERE shortcode IN (SELECT shortcode FROM results ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+        (RESULT_CACHE_MAX_ENTRIES,)
+    ).rowcount
+    stats['evictions'] += expired + overflow
+
+def get_ref(table, video_id):
+    try:
+        with db_lock:
+            row = get_db().execute(f'SELECT file_id, created_at FROM {table} WHERE video_id = ?', (video_id,)).fetchone()
+        if row and time.time() - row[1] <= RESULT_CACHE_TTL:
+            return row[0]
+    except Exception as e:
+        logger.error(f'Result cache read error: {e}')
+    return None
+
+def put_ref(table, video_id, file_id):
+    if not video_id or not file_id:
+        return
+    try:
+        with db_lock:
+            conn = get_db()
+            conn.execute(f'INSERT OR REPLACE INTO {table} (video_id, file_id, created_at) VALUES (?, ?, ?)', (video_id, file_id, time.time()))
+            conn.commit()
+    except Exception as e:
+        logger.error(f'Result cache write error: {e}')
+
+def get_audio(video_id):
+    return get_ref('audio', video_id)
+
+def put_audio(video_id, file_id):
+    put_ref('audio', video_id, file_id)
+
+def get_video(video_id):
+    return get_ref('videos', video_id)
+
+def put_video(video_id, file_id):
+    put_ref('videos', video_id, file_id)
+
+def collect_metrics():
+    return [
+        ('result_cache_total', 'counter', 'Result cache lookups and evictions',
+         [({'event': event}, count) for event, count in stats.items()])
+    ]
+
+metrics.register_collector(collect_metrics)
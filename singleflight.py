@@ -0,0 +1,55 @@
+import logging
+import threading
+import metrics
+
+logger = logging.getLogger(__name__)
+
+flights = {}
+flights_lock = threading.Lock()
+stats = {'leaders': 0, 'coalesced': 0}
+
+def do(key, fn, *args):
+    if key is None:
+        return fn(*args), False
+    
+    with flights_lock:
+        flight = flights.get(key)
+        if flight:
+            flight['followers'] += 1
+            stats['coalesced'] += 1
+            leader = False
+        else:
+            flight = {'done': threading.Event(), 'result': None, 'error': None, 'followers': 0}
+            flights[key] = flight
+            stats['leaders'] += 1
+            leader = True
+    
+    if not leader:
+        logger.info(f'Joined in-flight job for {key} ({stats["coalesced"]} coalesced so far)')
+        flight['done'].wait()
+        if flight['error']:
+            raise flight['error']
+        return flight['result'], True
+    
+    try:
+        flight['result'] = fn(*args)
+        return flight['result'], False
+    except Exception as e:
+        flight['error'] = e
+        raise
+    finally:
+        with flights_lock:
+            del flights[key]
+        flight['done'].set()
+        if flight['followers']:
+            logger.info(f'Fanned out {key} to {flight["followers"]} waiting request(s)')
+
+def collect_metrics():
+    with flights_lock:
+        return [
+            ('singleflight_in_flight', 'gauge', 'Shortcodes currently being fetched', [({}, len(flights))]),
+            ('singleflight_total', 'counter', 'Link jobs that led or joined a fetch',
+             [({'role': 'leader'}, stats['leaders']), ({'role': 'coalesced'}, stats['coalesced'])])
+        ]
+
+metrics.register_collector(collect_metrics)
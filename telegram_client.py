@@ -0,0 +1,130 @@
+import os
+import time
+import uuid
+import random
+import logging
+import requests
+import metrics
+import rate_limiter
+from requests.adapters import HTTPAdapter
+from config import (TELEGRAM_API, TELEGRAM_TIMEOUT, TELEGRAM_UPLOAD_TIMEOUT, TELEGRAM_MAX_RETRIES, TELEGRAM_POOL_SIZE,
+                    TELEGRAM_THROTTLE_RETRIES)
+
+logger = logging.getLogger(__name__)
+
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=2, pool_maxsize=TELEGRAM_POOL_SIZE)
+session.mount('https://', adapter)
+session.mount('http://', adapter)
+
+def record_latency(method, elapsed, outcome):
+    metrics.timing('telegram_request_seconds', elapsed, method=method, outcome=outcome)
+
+def upload_size(files):
+    size = 0
+    for value in files.values():
+        fileobj = value[1] if isinstance(value, tuple) else value
+        if hasattr(fileobj, 'fileno'):
+            size += os.fstat(fileobj.fileno()).st_size
+    return size
+
+def counted(chunks, method):
+    for chunk in chunks:
+        metrics.inc('telegram_upload_bytes_total', len(chunk), method=method)
+        yield chunk
+
+def backoff_delay(attempt):
+    return min(2 ** attempt, 30) + random.uniform(0, 0.5)
+
+def rewind(files):
+    for value in files.values():
+        fileobj = value[1] if isinstance(value, tuple) else value
+        if hasattr(fileobj, 'seek'):
+            fileobj.seek(0)
+
+def multipart_stream(fields, parts):
+    boundary = uuid.uuid4().hex
+    
+    def body():
+        for name, value in fields.items():
+            yield f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode('utf-8')
+        for name, filename, open_chunks in parts:
+            yield (
+                f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                f'Content-Type: application/octet-stream\r\n\r\n'
+            ).encode('utf-8')
+            for chunk in open_chunks():
+                yield chunk
+            yield b'\r\n'
+        yield f'--{boundary}--\r\n'.encode('utf-8')
+    
+    return body, f'multipart/form-data; boundary={boundary}'
+
+def call(method, payload=None, files=None, timeout=None, stream=None, chat_id=None, priority=None, cost=1):
+    if timeout is None:
+        timeout = TELEGRAM_UPLOAD_TIMEOUT if files or stream else TELEGRAM_TIMEOUT
+    if chat_id is None and payload:
+        chat_id = payload.get('chat_id')
+    if priority is None:
+        priority = rate_limiter.METHOD_PRIORITY.get(method)
+    limited = priority is not None and chat_id is not None
+    url = f'{TELEGRAM_API}/{method}'
+    
+    attempt = 0
+    throttles = 0
+    while True:
+        if files and (attempt or throttles):
+            rewind(files)
+        if limited:
+            rate_limiter.acquire(chat_id, priority, cost)
+        
+        start = time.time()
+        try:
+            if stream:
+                body, content_type = stream
+                response = session.post(url, data=counted(body(), method), headers={'Content-Type': content_type},
+                                        timeout=timeout)
+            elif files:
+                metrics.inc('telegram_upload_bytes_total', upload_size(files), method=method)
+                response = session.post(url, data=payload, files=files, timeout=timeout)
+            else:
+                response = session.post(url, json=payload, timeout=timeout)
+        except requests.ConnectionError as e:
+            record_latency(method, time.time() - start, 'connection_error')
+            if attempt == TELEGRAM_MAX_RETRIES:
+                raise
+            delay = backoff_delay(attempt)
+            attempt += 1
+            logger.warning(f'{method} connection error, retrying in {delay:.1f}s: {e}')
+            time.sleep(delay)
+            continue
+        except requests.Timeout:
+            record_latency(method, time.time() - start, 'timeout')
+            raise
+        
+        try:
+            body = response.json()
+        except ValueError:
+            body = {'ok': False, 'error_code': response.status_code, 'description': response.text[:200]}
+        record_latency(method, time.time() - start, 'ok' if response.ok else str(response.status_code))
+        
+        # Flood control is not a failure: wait out retry_after and queue the
+        # send again, with a separate budget from connection/5xx retries.
+        if response.status_code == 429 and throttles < TELEGRAM_THROTTLE_RETRIES:
+            throttles += 1
+            retry_after = (body.get('parameters') or {}).get('retry_after')
+            delay = retry_after if retry_after else backoff_delay(throttles)
+            logger.warning(f'{method} throttled for chat {chat_id}, retrying in {delay:.1f}s')
+            if limited:
+                rate_limiter.penalize(chat_id, delay)
+            else:
+                time.sleep(delay)
+            continue
+        
+        if response.status_code < 500 or attempt == TELEGRAM_MAX_RETRIES:
+            return body
+        
+        delay = backoff_delay(attempt)
+        attempt += 1
+        logger.warning(f'{method} returned {response.status_code}, retrying in {delay:.1f}s')
+        time.sleep(delay)
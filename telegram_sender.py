@@ -1,25 +1,38 @@
-import requests
+import os
+import json
 import logging
-from config import TELEGRAM_API
+import telegram_client
+from config import TELEGRAM_FILE_API, GET_FILE_MAX_SIZE_MB
 
 logger = logging.getLogger(__name__)
 
-def send_message(chat_id, text, reply_markup=None):
+MEDIA_GROUP_LIMIT = 10
+STREAM_CHUNK_SIZE = 256 * 1024
+
+def send_message(chat_id, text, reply_markup=None, priority=None):
     payload = {'chat_id': chat_id, 'text': text}
     if reply_markup:
         payload['reply_markup'] = reply_markup
     try:
-        response = requests.post(f'{TELEGRAM_API}/sendMessage', json=payload)
-        return response.json()
+        return telegram_client.call('sendMessage', payload, priority=priority)
     except Exception as e:
         logger.error(f'Send message error: {e}')
         return None
 
+def edit_message_text(chat_id, message_id, text, reply_markup=None):
+    payload = {'chat_id': chat_id, 'message_id': message_id, 'text': text}
+    if reply_markup:
+        payload['reply_markup'] = reply_markup
+    try:
+        return telegram_client.call('editMessageText', payload)
+    except Exception as e:
+        logger.error(f'Edit message error: {e}')
+        return None
+
 def delete_message(chat_id, message_id):
     try:
         payload = {'chat_id': chat_id, 'message_id': message_id}
-        response = requests.post(f'{TELEGRAM_API}/deleteMessage', json=payload)
-        return response.json()
+        return telegram_client.call('deleteMessage', payload)
     except Exception as e:
         logger.error(f'Delete message error: {e}')
         return None
@@ -33,22 +46,14 @@ def send_video(chat_id, video_path, caption=None, has_spoiler=False):
                 data['caption'] = caption
             if has_spoiler:
                 data['has_spoiler'] = has_spoiler
-            response = requests.post(f'{TELEGRAM_API}/sendVideo', data=data, files=files, timeout=300)
-        return response.json()
+            return telegram_client.call('sendVideo', data, files)
     except Exception as e:
         logger.error(f'Send video error: {e}')
         return None
 
 def send_video_with_button(chat_id, video_path, caption=None, video_id=None):
     try:
-        keyboard = None
-        if video_id:
-            keyboard = create_inline_keyboard([
-                [
-                    {'text': '🎵 Extract Audio', 'callback_data': f'audio:{video_id}'},
-                    {'text': '❌ No Audio', 'callback_data': f'noaudio:{video_id}'}
-                ]
-            ])
+        keyboard = audio_keyboard(video_id) if video_id else None
         
         with open(video_path, 'rb') as video:
             files = {'video': video}
@@ -56,14 +61,24 @@ def send_video_with_button(chat_id, video_path, caption=None, video_id=None):
             if caption:
                 data['caption'] = caption
             if keyboard:
-                import json
                 data['reply_markup'] = json.dumps(keyboard)
-            response = requests.post(f'{TELEGRAM_API}/sendVideo', data=data, files=files, timeout=300)
-        return response.json()
+            return telegram_client.call('sendVideo', data, files)
     except Exception as e:
         logger.error(f'Send video with button error: {e}')
         return None
 
+def send_video_by_file_id(chat_id, file_id, caption=None, video_id=None):
+    try:
+        payload = {'chat_id': chat_id, 'video': file_id, 'supports_streaming': True}
+        if caption:
+            payload['caption'] = caption
+        if video_id:
+            payload['reply_markup'] = audio_keyboard(video_id)
+        return telegram_client.call('sendVideo', payload)
+    except Exception as e:
+        logger.error(f'Send cached video error: {e}')
+        return None
+
 def send_photo(chat_id, photo_path, caption=None):
     try:
         with open(photo_path, 'rb') as photo:
@@ -71,12 +86,117 @@ def send_photo(chat_id, photo_path, caption=None):
             data = {'chat_id': chat_id}
             if caption:
                 data['caption'] = caption
-            response = requests.post(f'{TELEGRAM_API}/sendPhoto', data=data, files=files, timeout=120)
-        return response.json()
+            return telegram_client.call('sendPhoto', data, files)
     except Exception as e:
         logger.error(f'Send photo error: {e}')
         return None
 
+def send_photo_by_file_id(chat_id, file_id, caption=None):
+    try:
+        payload = {'chat_id': chat_id, 'photo': file_id}
+        if caption:
+            payload['caption'] = caption
+        return telegram_client.call('sendPhoto', payload)
+    except Exception as e:
+        logger.error(f'Send cached photo error: {e}')
+        return None
+
+def file_chunks(path):
+    def open_chunks():
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+    return open_chunks
+
+def send_streamed_item(chat_id, item):
+    try:
+        fields = {'chat_id': chat_id}
+        if item.get('caption'):
+            fields['caption'] = item['caption']
+        if item['type'] == 'video':
+            fields['supports_streaming'] = 'true'
+            if item.get('video_id'):
+                fields['reply_markup'] = json.dumps(audio_keyboard(item['video_id']))
+        method = 'sendVideo' if item['type'] == 'video' else 'sendPhoto'
+        stream = telegram_client.multipart_stream(fields, [(item['type'], item['filename'], item['chunks'])])
+        return telegram_client.call(method, stream=stream, chat_id=chat_id)
+    except Exception as e:
+        logger.error(f'Send streamed {item["type"]} error: {e}')
+        return None
+
+def send_media_group_chunk(chat_id, chunk):
+    handles = []
+    try:
+        media = []
+        files = {}
+        parts = []
+        streaming = any(item.get('chunks') for item in chunk)
+        for i, item in enumerate(chunk):
+            entry = {'type': item['type']}
+            if item.get('file_id'):
+                entry['media'] = item['file_id']
+            elif streaming:
+                name = f'file{i}'
+                open_chunks = item.get('chunks') or file_chunks(item['path'])
+                parts.append((name, item.get('filename') or os.path.basename(item['path']), open_chunks))
+                entry['media'] = f'attach://{name}'
+            else:
+                name = f'file{i}'
+                handle = open(item['path'], 'rb')
+                handles.append(handle)
+                files[name] = handle
+                entry['media'] = f'attach://{name}'
+            if item['type'] == 'video':
+                entry['supports_streaming'] = True
+            if item.get('caption'):
+                entry['caption'] = item['caption']
+            media.append(entry)
+        
+        # Every message in the album counts towards Telegram's flood limits.
+        if parts:
+            stream = telegram_client.multipart_stream({'chat_id': chat_id, 'media': json.dumps(media)}, parts)
+            return telegram_client.call('sendMediaGroup', stream=stream, chat_id=chat_id, cost=len(media))
+        if files:
+            return telegram_client.call('sendMediaGroup', {'chat_id': chat_id, 'media': json.dumps(media)}, files,
+                                        cost=len(media))
+        return telegram_client.call('sendMediaGroup', {'chat_id': chat_id, 'media': media}, cost=len(media))
+    except Exception as e:
+        logger.error(f'Send media group error: {e}')
+        return None
+    finally:
+        for handle in handles:
+            handle.close()
+
+def send_single_item(chat_id, item):
+    if item.get('chunks'):
+        return send_streamed_item(chat_id, dict(item, video_id=None))
+    if item['type'] == 'video':
+        if item.get('file_id'):
+            return send_video_by_file_id(chat_id, item['file_id'], item.get('caption'))
+        return send_video(chat_id, item['path'], item.get('caption'))
+    if item.get('file_id'):
+        return send_photo_by_file_id(chat_id, item['file_id'], item.get('caption'))
+    return send_photo(chat_id, item['path'], item.get('caption'))
+
+def send_media_group(chat_id, items):
+    responses = []
+    for start in range(0, len(items), MEDIA_GROUP_LIMIT):
+        chunk = items[start:start + MEDIA_GROUP_LIMIT]
+        
+        if len(chunk) > 1:
+            response = send_media_group_chunk(chat_id, chunk)
+            messages = response.get('result') if response and response.get('ok') else None
+            if messages and len(messages) == len(chunk):
+                responses.extend({'ok': True, 'result': message} for message in messages)
+                continue
+            logger.warning(f'Media group failed, sending {len(chunk)} item(s) individually')
+        
+        responses.extend(send_single_item(chat_id, item) for item in chunk)
+    return responses
+
 def send_audio(chat_id, audio_path, title=None):
     try:
         with open(audio_path, 'rb') as audio:
@@ -84,22 +204,124 @@ def send_audio(chat_id, audio_path, title=None):
             data = {'chat_id': chat_id}
             if title:
                 data['title'] = title
-            response = requests.post(f'{TELEGRAM_API}/sendAudio', data=data, files=files, timeout=180)
-        return response.json()
+            return telegram_client.call('sendAudio', data, files)
     except Exception as e:
         logger.error(f'Send audio error: {e}')
         return None
 
+def send_audio_by_file_id(chat_id, file_id, title=None):
+    try:
+        payload = {'chat_id': chat_id, 'audio': file_id}
+        if title:
+            payload['title'] = title
+        return telegram_client.call('sendAudio', payload)
+    except Exception as e:
+        logger.error(f'Send cached audio error: {e}')
+        return None
+
+def file_url(file_id):
+    response = telegram_client.call('getFile', {'file_id': file_id})
+    if not response or not response.get('ok'):
+        logger.error(f'Get file error: {response.get("description") if response else "no response"}')
+        return None
+    return f'{TELEGRAM_FILE_API}/{response["result"]["file_path"]}'
+
+def stream_file(file_id):
+    url = file_url(file_id)
+    if not url:
+        return None
+    
+    def open_chunks():
+        with telegram_client.session.get(url, stream=True, timeout=120) as download:
+            download.raise_for_status()
+            for chunk in download.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                yield chunk
+    return open_chunks
+
+def download_file(file_id, dest_path):
+    try:
+        url = file_url(file_id)
+        if not url:
+            return None
+        with telegram_client.session.get(url, stream=True, timeout=120) as download:
+            download.raise_for_status()
+            with open(dest_path, 'wb') as f:
+                for chunk in download.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                    f.write(chunk)
+        return dest_path
+    except Exception as e:
+        logger.error(f'Download file error: {e}')
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        return None
+
 def answer_callback(callback_id, text=None):
     try:
         payload = {'callback_query_id': callback_id}
         if text:
             payload['text'] = text
-        response = requests.post(f'{TELEGRAM_API}/answerCallbackQuery', json=payload)
-        return response.json()
+        return telegram_client.call('answerCallbackQuery', payload)
     except Exception as e:
         logger.error(f'Answer callback error: {e}')
         return None
 
+def get_updates(offset=None, timeout=30):
+    payload = {'timeout': timeout, 'allowed_updates': ['message', 'callback_query']}
+    if offset:
+        payload['offset'] = offset
+    try:
+        response = telegram_client.call('getUpdates', payload, timeout=timeout + 10)
+        if response and response.get('ok'):
+            return response['result']
+        logger.error(f'Get updates error: {response.get("description") if response else "no response"}')
+    except Exception as e:
+        logger.error(f'Get updates error: {e}')
+    return None
+
+def delete_webhook():
+    try:
+        return telegram_client.call('deleteWebhook', {'drop_pending_updates': False})
+    except Exception as e:
+        logger.error(f'Delete webhook error: {e}')
+        return None
+
 def create_inline_keyboard(buttons):
     return {'inline_keyboard': buttons}
+
+def audio_keyboard(video_id):
+    return create_inline_keyboard([
+        [
+            {'text': '🎵 Extract Audio', 'callback_data': f'audio:{video_id}'},
+            {'text': '❌ No Audio', 'callback_data': f'noaudio:{video_id}'}
+        ]
+    ])
+
+def media_audio_keyboard(video_ids):
+    return create_inline_keyboard([
+        [
+            {'text': f'🎵 Audio {position}', 'callback_data': f'audio:{video_id}'},
+            {'text': f'❌ No Audio {position}', 'callback_data': f'noaudio:{video_id}'}
+        ]
+        for position, video_id in video_ids
+    ])
+
+def response_media(response, kind):
+    if not response or not response.get('ok'):
+        return None
+    media = response.get('result', {}).get(kind)
+    if isinstance(media, list):
+        media = media[-1] if media else None
+    return media or None
+
+def get_file_id(response, kind):
+    media = response_media(response, kind)
+    return media.get('file_id') if media else None
+
+def get_file_size(response, kind):
+    media = response_media(response, kind)
+    return media.get('file_size') if media else None
+
+def fits_get_file(size):
+    # getFile refuses anything over 20 MB, so bigger uploads can't be
+    # fetched back from Telegram.
+    return bool(size) and size <= GET_FILE_MAX_SIZE_MB * 1024 * 1024
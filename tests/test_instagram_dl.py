@@ -0,0 +1,30 @@
+from instagram_dl import extract_instagram_urls
+
+def test_dedupes_links_by_shortcode():
+    text = ('https://www.instagram.com/p/Abc123/ and instagram.com/p/Abc123/?igsh=x '
+            'and https://m.instagram.com/someone/reel/Xyz_9-/')
+    assert extract_instagram_urls(text) == [
+        'https://www.instagram.com/p/Abc123/',
+        'https://www.instagram.com/reel/Xyz_9-/'
+    ]
+
+def test_reads_text_link_entities():
+    entities = [
+        {'type': 'text_link', 'offset': 0, 'length': 4, 'url': 'https://www.instagram.com/reels/Def456/'},
+        {'type': 'bold', 'offset': 5, 'length': 4}
+    ]
+    assert extract_instagram_urls('this post', entities) == ['https://www.instagram.com/reel/Def456/']
+
+def test_caption_only_message():
+    from handlers import message_links
+    message = {
+        'chat': {'id': 1},
+        'photo': [{'file_id': 'x'}],
+        'caption': 'look instagram.com/tv/Ghi789 and this',
+        'caption_entities': [{'type': 'text_link', 'offset': 34, 'length': 4, 'url': 'https://instagram.com/p/Jkl012/'}]
+    }
+    assert message_links(message) == ['https://www.instagram.com/tv/Ghi789/', 'https://www.instagram.com/p/Jkl012/']
+
+def test_ignores_audio_pages():
+    text = 'https://www.instagram.com/reels/audio/12345/ https://www.instagram.com/reel/audio/'
+    assert extract_instagram_urls(text) == []
@@ -0,0 +1,70 @@
+import json
+import socket
+import time
+from types import SimpleNamespace
+import pytest
+import janitor
+import job_store
+from config import CHAT_LOCK_LEASE
+
+@pytest.fixture(autouse=True)
+def job_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_store, 'JOB_DB_PATH', str(tmp_path / 'jobs.db'))
+    monkeypatch.setattr(job_store, 'local', job_store.threading.local())
+    monkeypatch.setattr(job_store, 'schema_ready', False)
+    yield
+
+def add_job(owner, chat_id, files=(), updated_at=None):
+    cursor = job_store.get_db().execute(
+        "INSERT INTO jobs (chat_id, payload, state, stage, owner, attempts, files, updated_at) VALUES (?, ?, 'running', 'download', ?, 1, ?, ?)",
+        (chat_id, json.dumps({'message': {'chat': {'id': chat_id}}}), owner, json.dumps(list(files)),
+         time.time() if updated_at is None else updated_at)
+    )
+    return cursor.lastrowid
+
+def test_recover_resumes_jobs_of_restarted_process_with_same_pid(tmp_path):
+    # Same hostname and PID as this process, but an earlier boot.
+    dead_owner = f'{socket.gethostname()}:{job_store.os.getpid()}:0ldb00t'
+    leftover = tmp_path / 'leftover.mp4'
+    leftover.write_bytes(b'x')
+    job_id = add_job(dead_owner, 42, [str(leftover)])
+    job_store.get_db().execute('INSERT INTO chat_locks (chat_id, owner, lease_until) VALUES (?, ?, ?)',
+                               (42, dead_owner, time.time() + CHAT_LOCK_LEASE))
+    
+    assert job_store.owner_alive(dead_owner) is False
+    assert job_store.acquire_chat(42)
+    
+    resumed, failed = job_store.recover()
+    
+    assert [job['id'] for job in resumed] == [job_id]
+    assert failed == []
+    assert str(leftover) not in job_store.active_files()
+    assert not leftover.exists()
+
+def test_recover_takes_over_other_host_jobs_once_lease_passes(monkeypatch):
+    now = time.time()
+    job_id = add_job('other-host:7:abc123', 43, updated_at=now)
+    
+    assert job_store.recover() == ([], [])
+    
+    monkeypatch.setattr(job_store, 'time', SimpleNamespace(time=lambda: now + CHAT_LOCK_LEASE + 1))
+    resumed, failed = job_store.recover()
+    
+    assert [job['id'] for job in resumed] == [job_id]
+    assert failed == []
+
+def test_released_job_is_recovered_again():
+    job_id = add_job('other-host:7:abc123', 44, updated_at=0)
+    resumed, _ = job_store.recover()
+    assert [job['id'] for job in resumed] == [job_id]
+    
+    job_store.release_job(job_id)
+    resumed, _ = job_store.recover()
+    assert [job['id'] for job in resumed] == [job_id]
+
+def test_janitor_sweep_runs_recovery(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(janitor, 'TEMP_DIR', str(tmp_path))
+    monkeypatch.setattr(janitor, 'recover_hook', lambda: calls.append(True))
+    janitor.sweep()
+    assert calls == [True]
@@ -0,0 +1,151 @@
+import os
+import math
+import time
+import fcntl
+import logging
+import threading
+from contextlib import contextmanager
+import metrics
+from config import TRANSCODE_SLOTS, TRANSCODE_PRESET, TRANSCODE_TIMEOUT, TRANSCODE_SLOT_DIR, TRANSCODE_SLOT_WAIT
+from job_queue import current_job
+
+logger = logging.getLogger(__name__)
+
+PRESETS = ['medium', 'fast', 'faster', 'veryfast', 'superfast', 'ultrafast']
+SLOT_POLL_INTERVAL = 0.25
+SPEED_SMOOTHING = 0.3
+
+state_lock = threading.Lock()
+waiting = 0
+speeds = {}
+
+def cgroup_cpu_limit():
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()[:2]
+        if quota != 'max':
+            return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+def available_cores():
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    return min(cores, limit) if limit else cores
+
+CORES = available_cores()
+SLOTS = TRANSCODE_SLOTS or max(1, int(CORES))
+THREADS = max(1, int(CORES // SLOTS))
+
+def choose_preset(depth):
+    base = PRESETS.index(TRANSCODE_PRESET) if TRANSCODE_PRESET in PRESETS else 0
+    if CORES < 1:
+        base += 1
+    return PRESETS[min(len(PRESETS) - 1, base + math.ceil(depth / SLOTS))]
+
+def encode_timeout(preset, duration):
+    if duration <= 0:
+        return TRANSCODE_TIMEOUT
+    with state_lock:
+        speed = speeds.get(preset, {}).get('speed')
+    expected = duration / speed if speed else duration
+    return max(TRANSCODE_TIMEOUT, int(expected * 3))
+
+def try_slot():
+    os.makedirs(TRANSCODE_SLOT_DIR, exist_ok=True)
+    for i in range(SLOTS):
+        handle = open(f'{TRANSCODE_SLOT_DIR}/slot_{i}.lock', 'a')
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return handle
+        except BlockingIOError:
+            handle.close()
+    return None
+
+def record(preset, duration, elapsed, waited):
+    speed = duration / elapsed
+    metrics.timing('transcode_seconds', elapsed, preset=preset)
+    metrics.observe('transcode_wait_seconds', waited)
+    metrics.inc('transcode_media_seconds_total', duration, preset=preset)
+    with state_lock:
+        stats = speeds.setdefault(preset, {'count': 0, 'speed': speed, 'encoded_seconds': 0.0, 'busy_seconds': 0.0})
+        stats['count'] += 1
+        stats['speed'] += (speed - stats['speed']) * SPEED_SMOOTHING
+        stats['encoded_seconds'] += duration
+        stats['busy_seconds'] += elapsed
+
+    job = current_job()
+    if job is not None:
+        job['timings']['encode_wait'] = job['timings'].get('encode_wait', 0) + waited
+        job.setdefault('encode_speeds', []).append(f'{speed:.2f}x/{preset}')
+    logger.info(f'Encoded {duration:.0f}s of video in {elapsed:.1f}s ({speed:.2f}x realtime, preset={preset}, '
+                f'threads={THREADS}, waited {waited:.1f}s)')
+
+@contextmanager
+def transcode_slot(duration=0):
+    # Slots are flock()ed files so the cap holds across gunicorn workers
+    # sharing the box, not only across threads in this process.
+    global waiting
+    with state_lock:
+        waiting += 1
+    start = time.time()
+    handle = None
+    try:
+        while handle is None:
+            handle = try_slot()
+            if handle is None:
+                if time.time() - start > TRANSCODE_SLOT_WAIT:
+                    raise TimeoutError(f'No transcode slot free after {TRANSCODE_SLOT_WAIT}s')
+                time.sleep(SLOT_POLL_INTERVAL)
+    finally:
+        with state_lock:
+            waiting -= 1
+            depth = waiting
+
+    waited = time.time() - start
+    preset = choose_preset(depth)
+    encode = {'preset': preset, 'threads': THREADS, 'timeout': encode_timeout(preset, duration)}
+    started = time.time()
+    try:
+        yield encode
+    finally:
+        elapsed = time.time() - started
+        fcntl.flock(handle, fcntl.LOCK_UN)
+        handle.close()
+
+    if duration > 0 and elapsed > 0:
+        record(preset, duration, elapsed, waited)
+
+def encode_stats():
+    with state_lock:
+        return {
+            'cores': CORES,
+            'slots': SLOTS,
+            'threads': THREADS,
+            'waiting': waiting,
+            'presets': {preset: dict(stats) for preset, stats in speeds.items()}
+        }
+
+def collect_metrics():
+    with state_lock:
+        return [
+            ('transcode_waiting', 'gauge', 'Encodes waiting for a transcode slot', [({}, waiting)]),
+            ('transcode_slots', 'gauge', 'Concurrent encodes allowed on this box', [({}, SLOTS)]),
+            ('transcode_speed', 'gauge', 'Smoothed encode speed in x realtime by preset',
+             [({'preset': preset}, stats['speed']) for preset, stats in speeds.items()])
+        ]
+
+metrics.register_collector(collect_metrics)